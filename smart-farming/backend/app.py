@@ -1,6 +1,26 @@
-from flask import Flask, jsonify
+import base64
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import tracemalloc
+from functools import wraps
+
+from flask import Flask, jsonify, make_response, request, stream_with_context
 from flask_cors import CORS
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
 from scripts.query_service import (
+    DEFAULT_FARM,
+    FARMS,
+    UnknownFarmError,
+    get_dataset,
+    list_farms,
     list_plots,
     get_plot_year_summary,
     get_plots_needing_fertilizer,
@@ -8,69 +28,525 @@ from scripts.query_service import (
     get_cereal_crops,
     get_plots_to_postpone_fertilizer,
     get_plots_high_pest_risk,
-    get_next_crop_recommendations,
+    iter_next_crop_recommendations,
+    get_rotation_plan,
+    DEFAULT_ROTATION,
+    DEFAULT_LOOKBACK,
+    get_yield_analytics,
+    YIELD_DIMENSIONS,
+    get_analog_plots,
+    run_sparql,
+    EXPORT_COLUMNS,
+    iter_export_rows,
+    iter_export_triples,
+    subscribe_recommendations,
+    PROFILE_FUNCTIONS,
+    debug_report,
 )
+import scripts.query_service as query_service
+from scripts.diagnostics import sample_profile, tracemalloc_report
+from scripts.events import KEEPALIVE_SECONDS, sse_message
+from scripts.export import iter_columnar, iter_csv, iter_ntriples
 
 app = Flask(__name__)
 CORS(app)
 
+# Responses smaller than this are not worth compressing.
+COMPRESS_MIN_BYTES = 1024
+
+# Upper bound for ?limit= on paginated endpoints.
+MAX_PAGE_SIZE = 1000
+
+# /api/debug/* exists only when SF_DEBUG=1; it exposes process internals.
+DEBUG_ENDPOINTS = os.environ.get("SF_DEBUG") == "1"
+
+# Longest /api/debug/profile run. Kept well under the ASGI analytic pool's
+# default 30 s timeout (asgi.py), so a full-length profile still gets its
+# response instead of a 504 while the worker runs on.
+PROFILE_MAX_SECONDS = 20.0
+
+
+# ---------------------------------------------------------------------
+# Farms
+# ---------------------------------------------------------------------
+def farm_route(rule, **options):
+    """
+    Register a data route for the default farm at `rule` and for any farm
+    at the same path under /api/farms/<farm_id>/.
+    """
+    def decorator(view):
+        app.add_url_rule(rule, view.__name__, view, **options)
+        app.add_url_rule(
+            rule.replace("/api/", "/api/farms/<farm_id>/", 1),
+            view.__name__, view, **options,
+        )
+        return view
+    return decorator
+
+
+@app.errorhandler(UnknownFarmError)
+def unknown_farm(e):
+    return jsonify({"error": "Unknown farm", "farm_id": str(e.args[0]) if e.args else None}), 404
+
+
+# ---------------------------------------------------------------------
+# Conditional requests + compression
+# ---------------------------------------------------------------------
+def _request_etag(variant=None):
+    """Strong ETag for the current URL (and variant) at the farm's current graph version."""
+    farm_id = (request.view_args or {}).get("farm_id", DEFAULT_FARM)
+    key = f"{get_dataset(farm_id).version}|{request.full_path}"
+    if variant is not None:
+        key += f"|{variant}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def conditional(view=None, *, variant=None):
+    """
+    Tag a GET view with an ETag derived from the graph version (other
+    methods pass straight through).
+
+    If the client already holds the current representation (If-None-Match),
+    answer 304 without running the view and therefore without any query.
+
+    For views that negotiate their format from the Accept header, `variant`
+    returns the name of the representation chosen for this request. It is
+    part of the ETag, and responses carry Vary: Accept.
+    """
+    if view is None:
+        return lambda view: conditional(view, variant=variant)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != "GET":
+            return view(*args, **kwargs)
+        etag = _request_etag(variant() if variant else None)
+        # Compressed variants carry a coding suffix, see compress_response.
+        for candidate in (etag, f"{etag}-gzip", f"{etag}-br"):
+            if request.if_none_match.contains(candidate):
+                resp = app.response_class(status=304)
+                resp.set_etag(candidate)
+                resp.headers["Cache-Control"] = "no-cache"
+                resp.vary.add("Accept-Encoding")
+                if variant:
+                    resp.vary.add("Accept")
+                return resp
+
+        resp = make_response(view(*args, **kwargs))
+        if resp.status_code == 200:
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "no-cache"
+        if variant:
+            resp.vary.add("Accept")
+        return resp
+    return wrapper
 
-@app.route("/api/plots", methods=["GET"])
-def api_list_plots():
-    plots = list_plots()
+
+def _pick_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+@app.after_request
+def compress_response(resp):
+    if resp.mimetype != "application/json":
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if (
+        resp.status_code != 200
+        or resp.direct_passthrough
+        or resp.is_streamed
+        or "Content-Encoding" in resp.headers
+    ):
+        return resp
+
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return resp
+
+    encoding = _pick_encoding()
+    if encoding is None:
+        return resp
+    if encoding == "br":
+        resp.set_data(brotli.compress(data))
+    else:
+        resp.set_data(gzip.compress(data, compresslevel=6))
+    resp.headers["Content-Encoding"] = encoding
+
+    # A strong ETag must differ between content codings of the same body.
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(f"{etag}-{encoding}")
+    return resp
+
+
+@farm_route("/api/plots", methods=["GET"])
+@conditional
+def api_list_plots(farm_id=DEFAULT_FARM):
+    plots = list_plots(farm=farm_id)
     return jsonify({"plots": plots})
 
 
-@app.route("/api/plots/<plot_id>/year/<int:year>", methods=["GET"])
-def api_plot_year(plot_id, year):
-    data = get_plot_year_summary(plot_id, year)
+@farm_route("/api/plots/<plot_id>/year/<int:year>", methods=["GET"])
+@conditional
+def api_plot_year(plot_id, year, farm_id=DEFAULT_FARM):
+    data = get_plot_year_summary(plot_id, year, farm=farm_id)
     if data is None:
         return jsonify({"error": "No data found", "plot_id": plot_id, "year": year}), 404
     return jsonify(data)
 
-@app.route("/api/recommendations/needs-fertilizer", methods=["GET"])
-def api_needs_fertilizer():
-    plots = get_plots_needing_fertilizer()
+@farm_route("/api/plots/<plot_id>/year/<int:year>/analogs", methods=["GET"])
+@conditional
+def api_plot_year_analogs(plot_id, year, farm_id=DEFAULT_FARM):
+    k = max(1, min(request.args.get("k", 5, type=int), 100))
+    analogs = get_analog_plots(plot_id, year, k=k, farm=farm_id)
+    if analogs is None:
+        return jsonify({"error": "No data found", "plot_id": plot_id, "year": year}), 404
+    return jsonify({"plot_id": plot_id, "year": year, "k": k, "analogs": analogs})
+
+@farm_route("/api/recommendations/needs-fertilizer", methods=["GET"])
+@conditional
+def api_needs_fertilizer(farm_id=DEFAULT_FARM):
+    plots = get_plots_needing_fertilizer(farm=farm_id)
     return jsonify({
         "recommendation": "NeedsFertilizerPlot",
         "plots": plots,
     })
 
 
-@app.route("/api/crops/legumes", methods=["GET"])
-def api_legume_crops():
-    crops = get_legume_crops()
+@farm_route("/api/crops/legumes", methods=["GET"])
+@conditional
+def api_legume_crops(farm_id=DEFAULT_FARM):
+    crops = get_legume_crops(farm=farm_id)
     return jsonify({"legume_crops": crops})
 
 
-@app.route("/api/crops/cereals", methods=["GET"])
-def api_cereal_crops():
-    crops = get_cereal_crops()
+@farm_route("/api/crops/cereals", methods=["GET"])
+@conditional
+def api_cereal_crops(farm_id=DEFAULT_FARM):
+    crops = get_cereal_crops(farm=farm_id)
     return jsonify({"cereal_crops": crops})
 
 
-@app.route("/api/recommendations/postpone-fertilizer", methods=["GET"])
-def api_postpone_fertilizer():
-    plots = get_plots_to_postpone_fertilizer()
+@farm_route("/api/recommendations/postpone-fertilizer", methods=["GET"])
+@conditional
+def api_postpone_fertilizer(farm_id=DEFAULT_FARM):
+    plots = get_plots_to_postpone_fertilizer(farm=farm_id)
     return jsonify({
         "recommendation": "PostponeFertilizerPlot",
         "plots": plots,
     })
 
-@app.route("/api/recommendations/high-pest-risk", methods=["GET"])
-def api_high_pest_risk():
-    plots = get_plots_high_pest_risk()
+@farm_route("/api/recommendations/high-pest-risk", methods=["GET"])
+@conditional
+def api_high_pest_risk(farm_id=DEFAULT_FARM):
+    plots = get_plots_high_pest_risk(farm=farm_id)
     return jsonify({
         "recommendation": "HighPestRiskPlot",
         "plots": plots,
     })
 
-@app.route("/api/recommendations/next-crop", methods=["GET"])
-def api_next_crop():
-    recs = get_next_crop_recommendations()
+@farm_route("/api/recommendations/events", methods=["GET"])
+def api_recommendation_events(farm_id=DEFAULT_FARM):
+    """
+    Server-sent events instead of polling. When new data is loaded, one
+    `recommendation-diff` event is sent per recommendation set that changed,
+    with the items added, removed and changed. Reconnecting clients get the
+    events they missed (Last-Event-ID).
+    """
+    last_event_id = request.headers.get("Last-Event-ID", type=int)
+    sub = subscribe_recommendations(farm_id, last_event_id)
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while not sub.closed:
+                event = sub.get(timeout=KEEPALIVE_SECONDS)
+                yield sse_message(event) if event else ": keepalive\n\n"
+        finally:
+            sub.close()
+
+    resp = app.response_class(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+# ---------------------------------------------------------------------
+# Pagination helpers
+# ---------------------------------------------------------------------
+def encode_cursor(plot_id, year):
+    raw = json.dumps([plot_id, year]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Return (plot_id, year) from an opaque cursor, or raise ValueError."""
+    try:
+        plot_id, year = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(plot_id), int(year)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _plot_filter_arg():
+    """?plot=A&plot=B and ?plot=A,B are both accepted."""
+    plot_ids = []
+    for value in request.args.getlist("plot"):
+        plot_ids.extend(p.strip() for p in value.split(",") if p.strip())
+    return plot_ids or None
+
+
+def _wants_ndjson():
+    if request.args.get("format") == "ndjson":
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+
+@farm_route("/api/recommendations/next-crop", methods=["GET"])
+@conditional(variant=lambda: "ndjson" if _wants_ndjson() else "json")
+def api_next_crop(farm_id=DEFAULT_FARM):
+    """
+    Query parameters (all optional):
+      plot, year_from, year_to, crop  - filters
+      limit, cursor                   - cursor pagination; the response carries
+                                        next_cursor while more rows remain
+      format=ndjson                   - stream one JSON object per line
+    """
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    cursor = request.args.get("cursor")
+    try:
+        after = decode_cursor(cursor) if cursor else None
+        rows = iter_next_crop_recommendations(
+            plot_ids=_plot_filter_arg(),
+            year_from=request.args.get("year_from", type=int),
+            year_to=request.args.get("year_to", type=int),
+            crop=request.args.get("crop"),
+            after=after,
+            farm=farm_id,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if _wants_ndjson():
+        def generate():
+            for count, item in enumerate(rows):
+                if limit is not None and count >= limit:
+                    break
+                yield json.dumps(item) + "\n"
+        return app.response_class(
+            stream_with_context(generate()), mimetype="application/x-ndjson"
+        )
+
+    if limit is None:
+        return jsonify({
+            "recommendation": "NextCropRotation",
+            "items": list(rows),
+        })
+
+    items = []
+    next_cursor = None
+    for item in rows:
+        if len(items) == limit:
+            last = items[-1]
+            next_cursor = encode_cursor(last["plot_id"], last["year"])
+            break
+        items.append(item)
     return jsonify({
         "recommendation": "NextCropRotation",
-        "items": recs,
+        "items": items,
+        "next_cursor": next_cursor,
+    })
+
+
+@farm_route("/api/recommendations/rotation-plan", methods=["GET"])
+@conditional
+def api_rotation_plan(farm_id=DEFAULT_FARM):
+    """One next-season recommendation per plot, from its latest seasons."""
+    sequence = request.args.get("sequence", DEFAULT_ROTATION)
+    lookback = request.args.get("lookback", DEFAULT_LOOKBACK, type=int)
+    try:
+        plan = get_rotation_plan(sequence, lookback, plot_ids=_plot_filter_arg(),
+                                 farm=farm_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "recommendation": "RotationPlan",
+        "rotation": sequence,
+        "items": plan,
+    })
+
+
+@farm_route("/api/analytics/yield", methods=["GET"])
+@conditional
+def api_yield_analytics(farm_id=DEFAULT_FARM):
+    """
+    ?group_by=treatment,crop        - roll-up dimensions (default: none, i.e. grand total)
+    &treatment=T1&year=2015 ...     - drill down to specific dimension values
+    """
+    group_by = [d.strip() for d in request.args.get("group_by", "").split(",") if d.strip()]
+    filters = {}
+    for dim in YIELD_DIMENSIONS:
+        value = request.args.get(dim)
+        if value is not None:
+            filters[dim] = value
+    try:
+        if "year" in filters:
+            filters["year"] = int(filters["year"])
+        cells = get_yield_analytics(group_by=group_by, filters=filters, farm=farm_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "metric": "yield_kg_per_ha",
+        "group_by": group_by,
+        "filters": filters,
+        "cells": cells,
+    })
+
+
+@farm_route("/api/sparql", methods=["GET", "POST"])
+@conditional
+def api_sparql(farm_id=DEFAULT_FARM):
+    """
+    Read-only SELECT queries for ad-hoc analysis.
+
+    GET  ?query=SELECT...
+    POST body as application/sparql-query, form field `query`, or JSON {"query": ...}
+    &limit=N                        - max rows (capped by SF_SPARQL_MAX_ROWS)
+    """
+    if request.method == "POST":
+        if request.mimetype == "application/sparql-query":
+            query = request.get_data(as_text=True)
+        elif request.is_json:
+            query = (request.get_json(silent=True) or {}).get("query")
+        else:
+            query = request.form.get("query")
+    else:
+        query = request.args.get("query")
+    if not query:
+        return jsonify({"error": "Missing query"}), 400
+
+    try:
+        result, cached = run_sparql(query, max_rows=request.args.get("limit", type=int),
+                                    farm=farm_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # A header, not a body field: a hit and a miss share one ETag.
+    response = jsonify(result)
+    response.headers["X-Cache"] = "HIT" if cached else "MISS"
+    return response
+
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ntriples": ("application/n-triples", "nt"),
+    "columnar": ("application/octet-stream", "sfcols"),
+}
+
+
+@farm_route("/api/export/<any(csv, ntriples, columnar):fmt>", methods=["GET"])
+@conditional
+def api_export(fmt, farm_id=DEFAULT_FARM):
+    """
+    Stream a slice of the plot data with chunked transfer.
+
+    ?plot=A,B&year_from=2015&year_to=2020&crop=Zea mays L.   - all optional
+    csv has the kbs_2024.csv columns; columnar is described in scripts/export.py.
+    """
+    filters = dict(
+        plot_ids=_plot_filter_arg(),
+        year_from=request.args.get("year_from", type=int),
+        year_to=request.args.get("year_to", type=int),
+        crop=request.args.get("crop"),
+        farm=farm_id,
+    )
+    if fmt == "ntriples":
+        body = iter_ntriples(iter_export_triples(**filters))
+    elif fmt == "columnar":
+        body = iter_columnar(iter_export_rows(**filters), EXPORT_COLUMNS)
+    else:
+        body = iter_csv(iter_export_rows(**filters), [name for name, _ in EXPORT_COLUMNS])
+
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    resp = app.response_class(stream_with_context(body), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="plots.{extension}"'
+    return resp
+
+
+# ---------------------------------------------------------------------
+# Debug endpoints (opt-in, see DEBUG_ENDPOINTS)
+# ---------------------------------------------------------------------
+if DEBUG_ENDPOINTS:
+
+    @farm_route("/api/debug/memory", methods=["GET"])
+    def api_debug_memory(farm_id=DEFAULT_FARM):
+        """
+        ?top=20                   - rows per table
+        ?tracemalloc=start|stop   - switch allocation tracing for this process
+        """
+        top = max(1, min(request.args.get("top", 20, type=int), 200))
+        action = request.args.get("tracemalloc")
+        if action == "start" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif action == "stop" and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return jsonify({
+            "pid": os.getpid(),
+            "dataset": debug_report(farm=farm_id, top=top),
+            "tracemalloc": tracemalloc_report(top=top),
+        })
+
+    @farm_route("/api/debug/profile", methods=["GET"])
+    def api_debug_profile(farm_id=DEFAULT_FARM):
+        """
+        Sampled CPU profile of one query_service function.
+
+        ?function=get_plots_high_pest_risk   - one of PROFILE_FUNCTIONS
+        &seconds=2                           - how long to keep calling it (max 20)
+        &interval_ms=5                       - sampling interval
+        &args={"plot_id": "T1_R1", "year": 2015}   - extra keyword arguments (JSON)
+        """
+        name = request.args.get("function")
+        if name not in PROFILE_FUNCTIONS:
+            return jsonify({"error": "Unknown function", "functions": list(PROFILE_FUNCTIONS)}), 400
+        seconds = max(0.1, min(request.args.get("seconds", 2.0, type=float),
+                               PROFILE_MAX_SECONDS))
+        interval = max(1.0, min(request.args.get("interval_ms", 5.0, type=float), 100.0))
+        func = getattr(query_service, name)
+        try:
+            kwargs = json.loads(request.args.get("args", "{}"))
+            if not isinstance(kwargs, dict):
+                raise ValueError("args must be a JSON object")
+            kwargs["farm"] = farm_id
+            # Checked against the signature up front, so a TypeError from
+            # inside the function is a server error, not a bad request.
+            inspect.signature(func).bind(**kwargs)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            profile = sample_profile(func, seconds, kwargs=kwargs,
+                                     interval=interval / 1000.0)
+        except ValueError as e:  # the function rejected its arguments
+            return jsonify({"error": str(e)}), 400
+        return jsonify(dict(profile, pid=os.getpid()))
+
+
+@app.route("/api/farms", methods=["GET"])
+def api_list_farms():
+    loaded = FARMS.loaded()
+    return jsonify({
+        "default": DEFAULT_FARM,
+        "farms": [
+            {"farm_id": fid, "loaded": fid in loaded, "memory_estimate_bytes": loaded.get(fid)}
+            for fid in list_farms()
+        ],
     })
 
 
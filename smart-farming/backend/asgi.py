@@ -0,0 +1,536 @@
+"""
+ASGI serving mode for the Flask app.
+
+    uvicorn asgi:application --port 5000
+
+Exposes exactly the routes in app.py. Requests are not run on the event loop;
+each one is handed to one of two bounded pools:
+
+  fast      - plot and crop lookups, threads in this process
+  analytic  - recommendations, analytics, everything else; worker processes
+              by default, so long rdflib evaluations hold neither this
+              process's GIL nor a farm's FarmDataset.lock
+
+Worker processes are started with forkserver (spawn where that is not
+available), never forked from this process: by then it runs the reloader
+and pool threads, and a child forked while one of them holds a lock would
+inherit the lock held forever. Each worker loads the graph once when it
+starts; the pool starts all of them up front.
+
+Each pool admits a fixed number of running + queued requests. Beyond that
+the server answers 503 with Retry-After instead of queueing forever. Every
+request has a deadline (504 when exceeded). A request still waiting in the
+queue when it times out or its client disconnects is cancelled and never
+runs.
+
+Recommendation event streams (/api/recommendations/events) are the
+exception: they stay open indefinitely, so they are served on the event
+loop itself and an idle client holds no worker.
+
+Streamed responses (exports, next-crop as NDJSON) run in a third pool,
+"stream", of threads in this process. Their chunks are passed to the event
+loop one at a time through a small bounded queue, so memory stays flat and
+a slow client slows the producer down instead of piling up a buffer. The
+pool timeout only bounds the wait for the response to start.
+
+Settings can be overridden with SF_<POOL>_WORKERS / _QUEUE / _TIMEOUT / _KIND
+environment variables, e.g. SF_ANALYTIC_TIMEOUT=60 or SF_ANALYTIC_KIND=thread.
+Keep SF_ANALYTIC_TIMEOUT above app.PROFILE_MAX_SECONDS (20), or the
+longest /api/debug/profile runs will time out.
+"""
+
+import asyncio
+import io
+import multiprocessing
+import os
+import re
+import sys
+import threading
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+# Loads the graph for the fast and stream pools, which run in this process.
+import app  # noqa: F401
+from scripts.events import KEEPALIVE_SECONDS, sse_message
+from scripts.query_service import DEFAULT_FARM, UnknownFarmError, subscribe_recommendations
+
+# Paths answered by the fast pool; anything else is analytic.
+FAST_ROUTES = re.compile(
+    r"^/api(/farms/[^/]+)?/(plots|plots/[^/]+/year/\d+(/analogs)?|crops/[^/]+)/?$"
+    r"|^/api/farms/?$"
+)
+
+# Server-sent event streams; served on the event loop, not in a pool.
+EVENT_ROUTES = re.compile(r"^/api(?:/farms/([^/]+))?/recommendations/events/?$")
+
+# Responses streamed chunk by chunk from the stream pool.
+STREAM_ROUTES = re.compile(r"^/api(/farms/[^/]+)?/export/[^/]+/?$")
+NDJSON_ROUTES = re.compile(r"^/api(/farms/[^/]+)?/recommendations/next-crop/?$")
+
+POOL_DEFAULTS = {
+    # name: (kind, workers, max queued beyond workers, timeout seconds)
+    "fast": ("thread", 8, 32, 5.0),
+    "analytic": ("process", 2, 8, 30.0),
+    "stream": ("thread", 4, 4, 30.0),
+}
+
+# Chunks a streamed response may have in flight to the event loop.
+STREAM_QUEUE_CHUNKS = 8
+
+
+# Start method for worker processes; see the module docstring.
+WORKER_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def _setting(pool, name, default, cast):
+    return cast(os.environ.get(f"SF_{pool.upper()}_{name}", default))
+
+
+# ---------------------------------------------------------------------
+# WSGI call, runnable in a thread or in a worker process
+# ---------------------------------------------------------------------
+def _environ(req):
+    environ = {
+        "REQUEST_METHOD": req["method"],
+        "SCRIPT_NAME": req["root_path"],
+        "PATH_INFO": req["path"],
+        "QUERY_STRING": req["query_string"],
+        "SERVER_NAME": req["server"][0],
+        "SERVER_PORT": str(req["server"][1]),
+        "SERVER_PROTOCOL": f"HTTP/{req['http_version']}",
+        "REMOTE_ADDR": req["client"][0] if req["client"] else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": req["scheme"],
+        "wsgi.input": io.BytesIO(req["body"]),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in req["headers"]:
+        key = name.upper().replace("-", "_")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif key == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = f"HTTP_{key}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def call_wsgi(req):
+    """
+    Run one request through the Flask WSGI app.
+
+    `req` is a plain dict so it can be pickled to a worker process.
+    Returns (status code, [(header, value), ...], body bytes).
+    """
+    # Already loaded by _load_app in a worker process.
+    from app import app as wsgi_app
+
+    environ = _environ(req)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    result = wsgi_app.wsgi_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started["status"], started["headers"], body
+
+
+def _load_app():
+    """Worker process initializer: load the graph before the first request."""
+    import app  # noqa: F401
+
+
+def stream_wsgi(req, emit, cancelled):
+    """
+    Run one request through the Flask WSGI app in this process, handing
+    ("start", status, headers) and then ("body", chunk) to `emit` as the
+    app produces them. `emit` blocks while the consumer is behind. Stops
+    early once `cancelled` (a threading.Event) is set.
+    """
+    from app import app as wsgi_app
+
+    def start_response(status, headers, exc_info=None):
+        emit(("start", int(status.split(" ", 1)[0]), headers))
+
+    result = wsgi_app.wsgi_app(_environ(req), start_response)
+    try:
+        for chunk in result:
+            if cancelled.is_set():
+                return
+            if chunk:
+                emit(("body", chunk))
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+
+def _is_stream(scope):
+    if STREAM_ROUTES.match(scope["path"]):
+        return True
+    if not NDJSON_ROUTES.match(scope["path"]):
+        return False
+    query = scope["query_string"].decode("latin-1")
+    accept = dict(scope["headers"]).get(b"accept", b"")
+    return "format=ndjson" in query.split("&") or b"application/x-ndjson" in accept
+
+
+# ---------------------------------------------------------------------
+# Bounded pools
+# ---------------------------------------------------------------------
+class BoundedPool:
+    """An executor plus an admission limit on running + queued requests."""
+
+    def __init__(self, name):
+        kind, workers, queue, timeout = POOL_DEFAULTS[name]
+        self.name = name
+        self.workers = _setting(name, "WORKERS", workers, int)
+        self.capacity = self.workers + _setting(name, "QUEUE", queue, int)
+        self.timeout = _setting(name, "TIMEOUT", timeout, float)
+        self.kind = _setting(name, "KIND", kind, str)
+        self.executor = self._new_executor()
+        self.in_flight = 0
+
+    def _new_executor(self):
+        if self.kind == "process":
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                initializer=_load_app,
+            )
+            # Workers are started on demand, one per submit that finds none
+            # idle: start them all now so no request waits for a graph load.
+            for _ in range(self.workers):
+                executor.submit(int)
+            return executor
+        return ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix=f"sf-{self.name}"
+        )
+
+    def submit(self, fn, *args):
+        """
+        executor.submit, replacing the executor first if it is broken. A
+        process pool whose worker died (OOM, kill) refuses all further work;
+        its pending futures have already failed, so it is simply dropped.
+        """
+        try:
+            return self.executor.submit(fn, *args)
+        except BrokenExecutor:
+            print(f"WARNING: {self.name} pool broken, starting new workers")
+            self.rebuild()
+            return self.executor.submit(fn, *args)
+
+    def rebuild(self, broken=None):
+        """Replace the executor (only if it is still `broken`, when given)."""
+        if broken is not None and broken is not self.executor:
+            return
+        old, self.executor = self.executor, self._new_executor()
+        old.shutdown(wait=False, cancel_futures=True)
+
+    def try_acquire(self):
+        if self.in_flight >= self.capacity:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, _future=None):
+        self.in_flight -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PooledApplication:
+    """ASGI application dispatching to the fast / analytic pools."""
+
+    def __init__(self):
+        self.pools = None
+
+    def _start(self):
+        if self.pools is None:
+            self.pools = {name: BoundedPool(name) for name in POOL_DEFAULTS}
+
+    def _stop(self):
+        if self.pools is not None:
+            for pool in self.pools.values():
+                pool.shutdown()
+            self.pools = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            self._start()
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        events = EVENT_ROUTES.match(scope["path"])
+        if events and scope["method"] == "GET":
+            await self._events(scope, receive, send, events.group(1) or DEFAULT_FARM)
+            return
+
+        if _is_stream(scope):
+            pool = self.pools["stream"]
+        elif FAST_ROUTES.match(scope["path"]):
+            pool = self.pools["fast"]
+        else:
+            pool = self.pools["analytic"]
+        if not pool.try_acquire():
+            await _send_error(send, 503, "Server busy, retry shortly",
+                              [(b"retry-after", b"1")])
+            return
+
+        req = {
+            "method": scope["method"],
+            "root_path": scope.get("root_path", ""),
+            "path": scope["path"],
+            "query_string": scope["query_string"].decode("latin-1"),
+            "server": scope.get("server") or ("localhost", 80),
+            "client": scope.get("client"),
+            "scheme": scope.get("scheme", "http"),
+            "http_version": scope.get("http_version", "1.1"),
+            "headers": [(k.decode("latin-1"), v.decode("latin-1"))
+                        for k, v in scope["headers"]],
+            "body": body,
+        }
+
+        if pool.name == "stream":
+            await self._stream(pool, req, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        executor = pool.executor
+        try:
+            future = pool.submit(call_wsgi, req)
+        except Exception as e:
+            pool.release()
+            print(f"ERROR submitting to {pool.name} pool for {scope['path']}: {e}")
+            await _send_error(send, 503, "Server busy, retry shortly",
+                              [(b"retry-after", b"1")])
+            return
+        # The slot is freed when the work actually ends, not when we stop
+        # waiting, so timed-out requests still count against the limit.
+        future.add_done_callback(
+            lambda f: loop.is_closed() or loop.call_soon_threadsafe(pool.release)
+        )
+
+        work = asyncio.wrap_future(future)
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+        done, _ = await asyncio.wait(
+            {work, disconnect}, timeout=pool.timeout,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+
+        if work not in done:
+            future.cancel()  # only succeeds if it never started
+            disconnect.cancel()
+            if disconnect not in done:
+                await _send_error(send, 504, "Request timed out")
+            return
+        disconnect.cancel()
+
+        try:
+            status, headers, payload = work.result()
+        except Exception as e:
+            print(f"ERROR in {pool.name} pool for {scope['path']}: {e}")
+            if isinstance(e, BrokenExecutor):
+                # A worker died under this request: start new workers now
+                # rather than on the next submit.
+                pool.rebuild(broken=executor)
+            await _send_error(send, 500, "Internal server error")
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+    async def _stream(self, pool, req, receive, send):
+        """
+        Send a streamed response chunk by chunk as the pool thread
+        produces it; never holds more than STREAM_QUEUE_CHUNKS chunks.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(STREAM_QUEUE_CHUNKS)
+        cancelled = threading.Event()
+
+        def emit(item):
+            # Blocks this pool thread until the event loop has room.
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def run():
+            error = None
+            try:
+                stream_wsgi(req, emit, cancelled)
+            except Exception as e:
+                error = e
+            if not cancelled.is_set() and not loop.is_closed():
+                emit(("end", error))
+
+        try:
+            future = pool.submit(run)
+        except Exception as e:
+            pool.release()
+            print(f"ERROR submitting to {pool.name} pool for {req['path']}: {e}")
+            await _send_error(send, 503, "Server busy, retry shortly",
+                              [(b"retry-after", b"1")])
+            return
+        future.add_done_callback(
+            lambda f: loop.is_closed() or loop.call_soon_threadsafe(pool.release)
+        )
+
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+        started = False
+        try:
+            while True:
+                getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                    {getter, disconnect},
+                    timeout=None if started else pool.timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if getter not in done:
+                    getter.cancel()
+                    if disconnect not in done and not started:
+                        await _send_error(send, 504, "Request timed out")
+                    return
+                item = getter.result()
+                if item[0] == "start":
+                    started = True
+                    await send({
+                        "type": "http.response.start",
+                        "status": item[1],
+                        "headers": [(k.encode("latin-1"), v.encode("latin-1"))
+                                    for k, v in item[2]],
+                    })
+                elif item[0] == "body":
+                    await send({"type": "http.response.body", "body": item[1],
+                                "more_body": True})
+                else:
+                    error = item[1]
+                    if error is not None:
+                        print(f"ERROR in {pool.name} pool for {req['path']}: {error}")
+                    if not started:
+                        await _send_error(send, 500, "Internal server error")
+                    else:
+                        await send({"type": "http.response.body", "body": b""})
+                    return
+        finally:
+            disconnect.cancel()
+            if not future.done():
+                # Stop the producer: it sees the flag after its pending put.
+                future.cancel()
+                cancelled.set()
+                while not queue.empty():
+                    queue.get_nowait()
+
+    async def _events(self, scope, receive, send, farm_id):
+        """
+        Stream recommendation diffs. Waiting clients hold no thread: the
+        publisher wakes this coroutine through the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        last_event_id = dict(scope["headers"]).get(b"last-event-id")
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_event_id = None
+
+        def notify():
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(wake.set)
+
+        try:
+            # The first subscriber of a farm computes its baseline snapshot.
+            sub = await loop.run_in_executor(
+                None, subscribe_recommendations, farm_id, last_event_id, notify
+            )
+        except UnknownFarmError:
+            await _send_error(send, 404, "Unknown farm")
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                        (b"cache-control", b"no-cache"),
+                        (b"x-accel-buffering", b"no")],
+        })
+        await send({"type": "http.response.body", "body": b"retry: 5000\n\n",
+                    "more_body": True})
+
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            while not sub.closed:
+                waiter = asyncio.ensure_future(wake.wait())
+                done, _ = await asyncio.wait(
+                    {waiter, disconnect}, timeout=KEEPALIVE_SECONDS,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                waiter.cancel()
+                if disconnect in done:
+                    return
+                wake.clear()
+                payload = "".join(sse_message(e) for e in sub.drain()) or ": keepalive\n\n"
+                await send({"type": "http.response.body",
+                            "body": payload.encode("utf-8"), "more_body": True})
+            # Dropped for falling behind; the client reconnects and catches up.
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnect.cancel()
+            sub.close()
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _send_error(send, status, message, extra_headers=()):
+    body = ('{"error": "%s"}' % message).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("ascii")),
+                    *extra_headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+application = PooledApplication()
@@ -0,0 +1,197 @@
+"""
+Guarded execution of ad-hoc, read-only SPARQL SELECT queries.
+
+Query text is normalized (comments dropped, whitespace collapsed outside
+strings and IRIs) and the parsed + translated algebra is cached by that
+text, so repeated questions skip the parser. Execution runs against a view
+of the farm graph that checks a per-query CPU budget on every triple
+lookup, and rows are pulled lazily and stop at the row limit, so a runaway
+query is cut off instead of running to completion.
+"""
+
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from rdflib import Graph
+from rdflib.paths import Path
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+
+PLAN_CACHE_SIZE = 256
+
+# The CPU budget is also checked every this many triples within one lookup.
+CHECK_EVERY = 1024
+
+# Strings, IRIs, comments and whitespace; everything else is kept verbatim.
+_TOKENS = re.compile(
+    r'"""(?:[^"\\]|\\.|"(?!""))*"""'
+    r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+    r'|"(?:[^"\\\n]|\\.)*"'
+    r"|'(?:[^'\\\n]|\\.)*'"
+    r"|<[^<>\"{}|^`\\\s]*>"
+    r"|(?:\s|#[^\n]*)+"
+)
+
+
+class SparqlQueryError(ValueError):
+    pass
+
+
+class QueryBudgetExceeded(SparqlQueryError):
+    pass
+
+
+class LRUCache:
+    """
+    Small thread-safe LRU mapping. With `sizeof`, `nbytes` keeps a running
+    total of sizeof(value) over the cached values.
+    """
+
+    def __init__(self, size, sizeof=None):
+        self.size = size
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._account(old, -1)
+            self._items[key] = value
+            self._account(value, 1)
+            while len(self._items) > self.size:
+                self._account(self._items.popitem(last=False)[1], -1)
+
+    def _account(self, value, sign):
+        if self.sizeof is not None:
+            self.nbytes += sign * self.sizeof(value)
+
+    def __len__(self):
+        return len(self._items)
+
+
+PLANS = LRUCache(PLAN_CACHE_SIZE)
+
+
+def normalize_query(text):
+    """Query text with comments removed and whitespace collapsed."""
+    def token(m):
+        t = m.group(0)
+        return " " if t[0] == "#" or t[0].isspace() else t
+    return _TOKENS.sub(token, text).strip()
+
+
+def _uses_service(node):
+    if isinstance(node, CompValue):
+        if node.name == "ServiceGraphPattern":
+            return True
+        return any(_uses_service(v) for v in node.values())
+    if isinstance(node, (list, tuple)):
+        return any(_uses_service(v) for v in node)
+    return False
+
+
+def prepare(text, namespaces, parse_lock):
+    """
+    (normalized text, prepared query) for a SELECT query, from the plan
+    cache when possible. Raises SparqlQueryError for anything that does
+    not parse, is not a SELECT, or would reach outside the graph (FROM,
+    SERVICE). `parse_lock` serializes the (not thread-safe) parser.
+    """
+    key = normalize_query(text)
+    plan = PLANS.get(key)
+    if plan is not None:
+        return key, plan
+
+    with parse_lock:
+        try:
+            plan = prepareQuery(key, initNs=namespaces)
+        except Exception as e:
+            raise SparqlQueryError(f"Could not parse query: {e}")
+    if plan.algebra.name != "SelectQuery":
+        raise SparqlQueryError("Only SELECT queries are allowed")
+    if plan.algebra.datasetClause:
+        raise SparqlQueryError("FROM / FROM NAMED are not allowed")
+    if _uses_service(plan.algebra):
+        raise SparqlQueryError("SERVICE is not allowed")
+
+    PLANS.put(key, plan)
+    return key, plan
+
+
+class BudgetedGraph(Graph):
+    """
+    View of `graph` (same store and identifier) whose triple lookups raise
+    QueryBudgetExceeded once this thread has used its CPU budget.
+
+    extra(s, p, o), if given, yields additional triples matching a
+    pattern, e.g. values kept outside the graph.
+    """
+
+    def __init__(self, graph, cpu_seconds, extra=None):
+        super().__init__(store=graph.store, identifier=graph.identifier,
+                         namespace_manager=graph.namespace_manager)
+        self.cpu_seconds = cpu_seconds
+        self.deadline = time.thread_time() + cpu_seconds
+        self.extra = extra
+
+    def check_budget(self):
+        if time.thread_time() > self.deadline:
+            raise QueryBudgetExceeded(
+                f"Query exceeded its CPU budget of {self.cpu_seconds:g}s"
+            )
+
+    def triples(self, triple):
+        self.check_budget()
+        for n, t in enumerate(super().triples(triple), 1):
+            if n % CHECK_EVERY == 0:
+                self.check_budget()
+            yield t
+        if self.extra is not None and not isinstance(triple[1], Path):
+            for n, t in enumerate(self.extra(*triple), 1):
+                if n % CHECK_EVERY == 0:
+                    self.check_budget()
+                yield t
+
+
+def execute(plan, graph, max_rows, cpu_seconds, extra=None):
+    """
+    Run a prepared SELECT against `graph`. Rows are produced lazily and
+    evaluation stops after `max_rows` (truncated=True in the result).
+    """
+    view = BudgetedGraph(graph, cpu_seconds, extra)
+    result = view.query(plan)
+    columns = [str(v) for v in result.vars]
+
+    rows = []
+    truncated = False
+    for row in result:
+        if len(rows) == max_rows:
+            truncated = True
+            break
+        rows.append({
+            name: str(value) if value is not None else None
+            for name, value in zip(columns, row)
+        })
+        view.check_budget()
+
+    return {"columns": columns, "rows": rows, "truncated": truncated}
+
+
+def result_nbytes(result):
+    """Rough in-memory size of an execute() result."""
+    return 200 + sum(
+        100 + sum(60 + len(v) for v in row.values() if v is not None)
+        for row in result["rows"]
+    )
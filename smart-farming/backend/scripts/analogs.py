@@ -0,0 +1,170 @@
+"""
+Nearest-neighbour search over normalized soil + weather feature vectors.
+
+Each plot-year becomes one point. Features are z-scored per column (missing
+values are imputed with the column mean, i.e. 0 after scaling) and stored
+in a KD-tree, so a top-k lookup skips the subtrees that cannot hold a
+closer point instead of visiting every plot-year.
+
+With 10 features the pruning weakens as points fill the space evenly. The
+plain-Python tree answers a top-5 query in well under a millisecond for a
+few thousand plot-years, and in about 3 ms for 30,000 unstructured points
+(`python scripts/analogs.py 30000` measures it here and checks the results
+against a linear scan).
+"""
+
+import heapq
+import math
+import random
+import sys
+import time
+
+# Leaves hold up to this many points and are scanned linearly.
+LEAF_SIZE = 16
+
+
+def normalize(rows):
+    """
+    Z-score each column of `rows` (lists of floats or None).
+
+    Returns (scaled rows, means, stds) so later query vectors can be
+    scaled the same way with `scale_vector`.
+    """
+    n_cols = len(rows[0]) if rows else 0
+    means, stds = [], []
+    for col in range(n_cols):
+        present = [r[col] for r in rows if r[col] is not None]
+        mean = sum(present) / len(present) if present else 0.0
+        var = sum((v - mean) ** 2 for v in present) / len(present) if present else 0.0
+        means.append(mean)
+        stds.append(math.sqrt(var) or 1.0)  # constant column -> scale 1
+    scaled = [scale_vector(r, means, stds) for r in rows]
+    return scaled, means, stds
+
+
+def scale_vector(values, means, stds):
+    return tuple(
+        0.0 if v is None else (v - m) / s
+        for v, m, s in zip(values, means, stds)
+    )
+
+
+class KDTree:
+    """Static KD-tree over equal-length tuples; points are never modified."""
+
+    def __init__(self, points):
+        self.points = points
+        self.dims = len(points[0]) if points else 0
+        self.root = self._build(list(range(len(points)))) if points else None
+
+    def _build(self, idx):
+        if len(idx) <= LEAF_SIZE:
+            return ("leaf", [(i, self.points[i]) for i in idx])
+        # Split on the widest dimension, which behaves better than pure
+        # round-robin when some features barely vary.
+        axis = max(
+            range(self.dims),
+            key=lambda a: max(self.points[i][a] for i in idx) - min(self.points[i][a] for i in idx),
+        )
+        idx.sort(key=lambda i: self.points[i][axis])
+        mid = len(idx) // 2
+        split = self.points[idx[mid]][axis]
+        return ("node", axis, split,
+                self._build(idx[:mid]),
+                self._build(idx[mid:]))
+
+    def query(self, point, k=5, exclude=()):
+        """Return [(distance, index), ...] for the k nearest points."""
+        if self.root is None or k <= 0:
+            return []
+        dist = math.dist
+        heap = []  # max-heap on distance via negation
+        worst = worst_sq = math.inf
+        # Each entry carries the squared distance from `point` to the
+        # node's cell and the per-axis offsets making it up, so crossing a
+        # split replaces that axis's term instead of taking the largest
+        # single offset as the bound.
+        stack = [(0.0, (0.0,) * self.dims, self.root)]
+        while stack:
+            bound_sq, offsets, node = stack.pop()
+            if bound_sq >= worst_sq:
+                continue
+            if node[0] == "leaf":
+                for i, p in node[1]:
+                    if i in exclude:
+                        continue
+                    d = dist(point, p)
+                    if len(heap) < k:
+                        heapq.heappush(heap, (-d, i))
+                        if len(heap) == k:
+                            worst = -heap[0][0]
+                            worst_sq = worst * worst
+                    elif d < worst:
+                        heapq.heapreplace(heap, (-d, i))
+                        worst = -heap[0][0]
+                        worst_sq = worst * worst
+                continue
+            _, axis, split, left, right = node
+            diff = point[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            far_sq = bound_sq - offsets[axis] ** 2 + diff * diff
+            # Far side is pushed first so the near side is explored first.
+            if far_sq < worst_sq:
+                far_offsets = offsets[:axis] + (diff,) + offsets[axis + 1:]
+                stack.append((far_sq, far_offsets, far))
+            stack.append((bound_sq, offsets, near))
+        return sorted((-d, i) for d, i in heap)
+
+
+class AnalogIndex:
+    """
+    KD-tree over plot-years.
+
+    keys:     [(plot_id, year), ...]
+    features: raw feature rows aligned with keys (floats or None)
+    extras:   per-key payload returned with each analog (e.g. yield)
+    """
+
+    def __init__(self, keys, features, extras=None):
+        self.keys = keys
+        self.position = {key: i for i, key in enumerate(keys)}
+        self.extras = extras or [None] * len(keys)
+        scaled, self.means, self.stds = normalize(features)
+        self.tree = KDTree(scaled)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def nearest(self, key, k=5):
+        """Top-k analogs of an indexed plot-year, excluding itself; None if unknown."""
+        i = self.position.get(key)
+        if i is None:
+            return None
+        hits = self.tree.query(self.tree.points[i], k=k, exclude={i})
+        return [(dist, self.keys[j], self.extras[j]) for dist, j in hits]
+
+
+def benchmark(n=30000, k=5, queries=200, dims=10, seed=1):
+    """
+    Mean milliseconds per top-k query over n random (unstructured) points,
+    after checking a sample of the answers against a linear scan.
+    """
+    rnd = random.Random(seed)
+    index = AnalogIndex(
+        list(range(n)), [[rnd.gauss(0.0, 1.0) for _ in range(dims)] for _ in range(n)]
+    )
+    keys = rnd.sample(range(n), min(queries, n))
+    started = time.perf_counter()
+    answers = [index.nearest(key, k) for key in keys]
+    elapsed = time.perf_counter() - started
+
+    points = index.tree.points
+    for key, answer in list(zip(keys, answers))[:10]:
+        expected = sorted(math.dist(points[key], p) for j, p in enumerate(points) if j != key)[:k]
+        assert [d for d, _, _ in answer] == expected, key
+    return elapsed / len(keys) * 1000.0
+
+
+if __name__ == "__main__":
+    for size in [int(a) for a in sys.argv[1:]] or [300, 3000, 30000]:
+        print(f"{size:>7} points: {benchmark(size):.2f} ms per top-5 query")
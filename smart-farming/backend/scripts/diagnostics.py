@@ -0,0 +1,189 @@
+"""
+Runtime diagnostics for the opt-in debug endpoints (SF_DEBUG=1).
+
+  triple_counts      - triples per rdf:type class and per predicate
+  deep_sizeof        - approximate bytes held by an index or cache
+  tracemalloc_report - top allocating source lines (tracing must be on)
+  sample_profile     - run a function repeatedly for N seconds while a
+                       sampler thread records the calling thread's stack
+
+Everything here reports on the current process only.
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from collections import Counter, deque
+
+from rdflib.namespace import RDF
+
+# Default interval between stack samples.
+SAMPLE_INTERVAL = 0.005
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _where(filename, line=None):
+    """Short location: relative to the backend, or to site-packages."""
+    if filename.startswith(BACKEND_DIR):
+        filename = os.path.relpath(filename, BACKEND_DIR)
+    elif "site-packages" in filename:
+        filename = filename.split("site-packages" + os.sep, 1)[1]
+    return f"{filename}:{line}" if line is not None else filename
+
+
+def triple_counts(graph, top=None):
+    """({class: subjects}, {predicate: triples}), largest first."""
+    classes = Counter()
+    predicates = Counter()
+    for _, p, o in graph:
+        predicates[str(p)] += 1
+        if p == RDF.type:
+            classes[str(o)] += 1
+    return dict(classes.most_common(top)), dict(predicates.most_common(top))
+
+
+# Never entered by deep_sizeof: shared by everything, not owned by an index.
+_NOT_OWNED = (types.ModuleType, type, types.FunctionType, types.BuiltinFunctionType,
+              types.MethodType)
+
+
+def deep_sizeof(obj, skip=()):
+    """
+    Approximate bytes reachable from `obj`: sys.getsizeof of every object
+    found through containers, instance dicts and slots, each counted once.
+    Objects of the `skip` types (e.g. a graph an index points into) are
+    not entered. Strings shared with the graph are included, so the sizes
+    of several indexes can overlap.
+    """
+    skip = _NOT_OWNED + tuple(skip)
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, skip):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend(o)
+        elif not isinstance(o, (str, bytes, int, float)):
+            if hasattr(o, "__dict__"):
+                stack.append(o.__dict__)
+            for cls in type(o).__mro__:
+                slots = cls.__dict__.get("__slots__", ())
+                for slot in (slots,) if isinstance(slots, str) else slots:
+                    if slot not in ("__dict__", "__weakref__") and hasattr(o, slot):
+                        stack.append(getattr(o, slot))
+    return total
+
+
+# ---------------------------------------------------------------------
+# tracemalloc
+# ---------------------------------------------------------------------
+def tracemalloc_report(top=20):
+    """
+    Top allocators by source line. Tracing only sees allocations made
+    after it started (PYTHONTRACEMALLOC=1 starts it with the process).
+    """
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing": True,
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "top": [
+            {
+                "where": _where(stat.traceback[0].filename, stat.traceback[0].lineno),
+                "size_bytes": stat.size,
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics("lineno")[:top]
+        ],
+    }
+
+
+# ---------------------------------------------------------------------
+# Sampling profiler
+# ---------------------------------------------------------------------
+def sample_profile(func, seconds, kwargs=None, interval=SAMPLE_INTERVAL, top=25):
+    """
+    Call func(**kwargs) back to back for `seconds` while another thread
+    samples this thread's stack every `interval` seconds.
+
+    "self" counts the line a sample was taken in, "cumulative" counts
+    every function on the stack, so a hot rdflib internal shows up in the
+    former and the query function that drives it in the latter.
+    """
+    kwargs = kwargs or {}
+    target = threading.get_ident()
+    own_code = sample_profile.__code__
+    self_counts = Counter()
+    cumulative = Counter()
+    samples = 0
+    stop = threading.Event()
+
+    def sampler():
+        nonlocal samples
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                continue
+            samples += 1
+            self_counts[(frame.f_code.co_name, _where(frame.f_code.co_filename, frame.f_lineno))] += 1
+            seen = set()
+            # Only frames below this function: the request handling above
+            # it is the same in every sample.
+            while frame is not None and frame.f_code is not own_code:
+                code = frame.f_code
+                key = (code.co_name, _where(code.co_filename, code.co_firstlineno))
+                if key not in seen:  # recursion counts once per sample
+                    seen.add(key)
+                    cumulative[key] += 1
+                frame = frame.f_back
+
+    thread = threading.Thread(target=sampler, name="sf-profiler", daemon=True)
+    calls = 0
+    started = time.perf_counter()
+    thread.start()
+    try:
+        while True:
+            func(**kwargs)
+            calls += 1
+            if time.perf_counter() - started >= seconds:
+                break
+    finally:
+        stop.set()
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    def rows(counter):
+        return [
+            {"function": name, "where": where, "samples": n,
+             "percent": round(100.0 * n / samples, 1)}
+            for (name, where), n in counter.most_common(top)
+        ]
+
+    return {
+        "function": getattr(func, "__name__", repr(func)),
+        "seconds": round(elapsed, 3),
+        "calls": calls,
+        "mean_call_ms": round(1000.0 * elapsed / calls, 3),
+        "interval_ms": interval * 1000.0,
+        "samples": samples,
+        "self": rows(self_counts),
+        "cumulative": rows(cumulative),
+    }
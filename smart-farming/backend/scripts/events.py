@@ -0,0 +1,111 @@
+"""
+In-process fan-out of server-sent events.
+
+An event is published once and appended to every subscriber's queue for
+its topic (a farm id), so the work behind it is done once however many
+clients are connected. Recent events are kept so a client that reconnects
+with Last-Event-ID gets what it missed. A subscriber whose queue fills up
+is closed instead of slowing the publisher down; its client reconnects
+and catches up from the history.
+"""
+
+import json
+from collections import deque
+from itertools import count
+from threading import Condition, Lock
+
+# Events kept for Last-Event-ID replay (all topics together).
+HISTORY_SIZE = 256
+
+# Undelivered events a subscriber may hold before it is dropped.
+QUEUE_SIZE = 64
+
+# Idle streams send a comment this often so proxies keep them open.
+KEEPALIVE_SECONDS = 15
+
+
+def sse_message(event):
+    """Wire format of one event (id, event, data)."""
+    event_id, name, data = event
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class Subscription:
+    def __init__(self, hub, topic, notify=None):
+        self.hub = hub
+        self.topic = topic
+        self.notify = notify    # called (from the publishing thread) on delivery
+        self.closed = False
+        self._events = deque()
+        self._cond = Condition()
+
+    def _deliver(self, event):
+        with self._cond:
+            if self.closed:
+                return
+            if len(self._events) >= QUEUE_SIZE:
+                self.closed = True
+            else:
+                self._events.append(event)
+            self._cond.notify()
+        if self.notify is not None:
+            self.notify()
+
+    def get(self, timeout=None):
+        """Next event, or None on timeout or once closed."""
+        with self._cond:
+            if not self._events and not self.closed:
+                self._cond.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    def drain(self):
+        """All pending events without blocking."""
+        with self._cond:
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self.hub._remove(self)
+
+
+class EventHub:
+    def __init__(self):
+        self._ids = count(1)
+        self._history = deque(maxlen=HISTORY_SIZE)  # (topic, event)
+        self._subscribers = {}                      # topic -> set of Subscription
+        self._lock = Lock()
+
+    def subscribe(self, topic, last_event_id=None, notify=None):
+        sub = Subscription(self, topic, notify)
+        with self._lock:
+            self._subscribers.setdefault(topic, set()).add(sub)
+            if last_event_id is not None:
+                for t, event in self._history:
+                    if t == topic and event[0] > last_event_id:
+                        sub._events.append(event)
+        return sub
+
+    def publish(self, topic, name, data):
+        with self._lock:
+            event = (next(self._ids), name, data)
+            self._history.append((topic, event))
+            subscribers = list(self._subscribers.get(topic, ()))
+        for sub in subscribers:
+            sub._deliver(event)
+        return event
+
+    def subscriber_count(self, topic):
+        with self._lock:
+            return len(self._subscribers.get(topic, ()))
+
+    def _remove(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.topic)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.topic]
@@ -0,0 +1,205 @@
+"""
+Streaming writers for plot data exports: CSV, N-Triples and a small
+columnar binary format.
+
+Every writer takes an iterator and yields bytes chunks of about
+CHUNK_BYTES, so a response can be sent with chunked transfer while only
+one chunk (or one columnar row group) is held in memory.
+
+Columnar format (all integers little-endian):
+
+    magic       b"SFCOLS1\\n"
+    schema      uint32 length, then UTF-8 JSON [[name, type], ...]
+                type is "f64", "i32", "bool" or "str"
+    row group   uint32 n_rows, then per column in schema order:
+                  uint8[n_rows] validity (1 = value present), padded to 4 bytes
+                  f64   float64[n_rows]
+                  i32   int32[n_rows]
+                  bool  uint8[n_rows], padded to 4 bytes
+                  str   uint32[n_rows + 1] offsets into a UTF-8 blob, then
+                        the blob padded to 4 bytes
+    end         uint32 0 (an empty row group)
+"""
+
+import csv
+import io
+import json
+import struct
+import sys
+from array import array
+
+from rdflib import Literal
+
+CHUNK_BYTES = 64 * 1024
+
+# Rows per columnar row group.
+ROW_GROUP_SIZE = 4096
+
+COLUMNAR_MAGIC = b"SFCOLS1\n"
+
+_U32 = struct.Struct("<I")
+_TYPECODES = {"f64": "d", "i32": "i", "bool": "B"}
+
+
+def _pad4(n):
+    return b"\0" * ((4 - n % 4) % 4)
+
+
+def _chunked(pieces):
+    """Join small byte strings into chunks of at least CHUNK_BYTES."""
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= CHUNK_BYTES:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+# ---------------------------------------------------------------------
+# CSV
+# ---------------------------------------------------------------------
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return value
+
+
+def iter_csv(rows, columns):
+    """rows: dicts keyed by the names in `columns` (the CSV header)."""
+    def pieces():
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_csv_value(row.get(name)) for name in columns])
+            if out.tell() >= CHUNK_BYTES:
+                yield out.getvalue().encode("utf-8")
+                out.seek(0)
+                out.truncate()
+        yield out.getvalue().encode("utf-8")
+    return _chunked(pieces())
+
+
+# ---------------------------------------------------------------------
+# N-Triples
+# ---------------------------------------------------------------------
+_NT_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r"})
+
+
+def nt_term(term):
+    if isinstance(term, Literal):
+        text = '"' + str(term).translate(_NT_ESCAPES) + '"'
+        if term.language:
+            return f"{text}@{term.language}"
+        if term.datatype:
+            return f"{text}^^<{term.datatype}>"
+        return text
+    return term.n3()
+
+
+def iter_ntriples(triples):
+    return _chunked(
+        f"{nt_term(s)} {nt_term(p)} {nt_term(o)} .\n".encode("utf-8")
+        for s, p, o in triples
+    )
+
+
+# ---------------------------------------------------------------------
+# Columnar
+# ---------------------------------------------------------------------
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _encode_group(group, schema):
+    parts = [_U32.pack(len(group))]
+    for name, kind in schema:
+        values = [row.get(name) for row in group]
+        valid = bytes(v is not None for v in values)
+        parts += [valid, _pad4(len(valid))]
+        if kind == "str":
+            encoded = [(v or "").encode("utf-8") for v in values]
+            offsets = array("I", [0])
+            for raw in encoded:
+                offsets.append(offsets[-1] + len(raw))
+            blob = b"".join(encoded)
+            parts += [_little_endian(offsets), blob, _pad4(len(blob))]
+        else:
+            default = 0.0 if kind == "f64" else 0
+            data = array(_TYPECODES[kind], [default if v is None else v for v in values])
+            raw = _little_endian(data)
+            parts += [raw, _pad4(len(raw))]
+    return b"".join(parts)
+
+
+def iter_columnar(rows, schema):
+    """schema: [(name, type), ...]; rows: dicts keyed by name."""
+    def pieces():
+        header = json.dumps([list(col) for col in schema]).encode("utf-8")
+        yield COLUMNAR_MAGIC + _U32.pack(len(header)) + header
+        group = []
+        for row in rows:
+            group.append(row)
+            if len(group) == ROW_GROUP_SIZE:
+                yield _encode_group(group, schema)
+                group = []
+        if group:
+            yield _encode_group(group, schema)
+        yield _U32.pack(0)
+    return _chunked(pieces())
+
+
+def read_columnar(fp):
+    """
+    Read a columnar export from a binary file object. Yields one
+    {name: [values...]} dict per row group (None where a value is missing).
+    """
+    def read(n):
+        data = fp.read(n)
+        if len(data) != n:
+            raise ValueError("Truncated columnar file")
+        return data
+
+    def skip_pad(n):
+        read((4 - n % 4) % 4)
+
+    if read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar export")
+    (length,) = _U32.unpack(read(4))
+    schema = json.loads(read(length))
+
+    while True:
+        (n_rows,) = _U32.unpack(read(4))
+        if n_rows == 0:
+            return
+        group = {}
+        for name, kind in schema:
+            valid = read(n_rows)
+            skip_pad(n_rows)
+            if kind == "str":
+                offsets = array("I")
+                offsets.frombytes(read(4 * (n_rows + 1)))
+                if sys.byteorder == "big":
+                    offsets.byteswap()
+                blob = read(offsets[-1])
+                skip_pad(len(blob))
+                values = [blob[offsets[i]:offsets[i + 1]].decode("utf-8")
+                          for i in range(n_rows)]
+            else:
+                data = array(_TYPECODES[kind])
+                data.frombytes(read(data.itemsize * n_rows))
+                skip_pad(data.itemsize * n_rows)
+                if sys.byteorder == "big":
+                    data.byteswap()
+                values = [bool(v) for v in data] if kind == "bool" else list(data)
+            group[name] = [v if ok else None for v, ok in zip(values, valid)]
+        yield group
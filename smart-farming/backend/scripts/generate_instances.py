@@ -2,14 +2,23 @@
 """
 Generate instances (TTL) from the smart-farming OWL schema and kbs_2024.csv.
 
+Usage:
+    python scripts/generate_instances.py                  # default farm
+    python scripts/generate_instances.py <farm_id> <csv>  # farms/<farm_id>/instances.ttl
+
+The CSV is read column by column: every distinct cell value of a column
+is parsed, validated and slugified once, and rows just look the result
+up. Rows or values that fail validation are left out and listed in
+<output>.errors.csv next to the TTL.
 """
 
 import csv
+import math
 import re
+import sys
 from pathlib import Path
 
-from rdflib import Graph, Namespace, URIRef, Literal
-from rdflib.namespace import RDF, RDFS, XSD
+from rdflib import Graph, Namespace
 
 
 # -------------------------------------------------------------------
@@ -23,45 +32,154 @@ OWL_PATH = PROJECT_ROOT / "ontology" / "smart-farming.owl"
 CSV_PATH = PROJECT_ROOT / "data" / "kbs_2024.csv"
 OUTPUT_TTL = PROJECT_ROOT / "ontology" / "instances.ttl"
 
+if len(sys.argv) == 3:
+    # Another farm: its own CSV, its own instance set for query_service.
+    sys.path.insert(0, str(PROJECT_ROOT))
+    from scripts.tenants import FARM_ID
+
+    if not FARM_ID.match(sys.argv[1]):
+        sys.exit(f"Invalid farm id {sys.argv[1]!r}: use 1-64 letters, digits, '_' or '-'")
+    CSV_PATH = Path(sys.argv[2]).resolve()
+    OUTPUT_TTL = PROJECT_ROOT / "farms" / sys.argv[1] / "instances.ttl"
+elif len(sys.argv) != 1:
+    sys.exit(__doc__)
+
+ERRORS_CSV = OUTPUT_TTL.with_name(OUTPUT_TTL.stem + ".errors.csv")
+
 BASE_URI = "http://example.org/smart-farming#"
 SF = Namespace(BASE_URI)
+XSD_URI = "http://www.w3.org/2001/XMLSchema#"
+
+# Accepted year range (rows outside it are skipped).
+YEAR_RANGE = (1800, 2200)
+
+# Numeric CSV columns: column -> (record, property, (min, max)).
+# Values outside the range are dropped and reported. Order is output order.
+FLOAT_COLUMNS = {
+    "Yield_kg_ha": ("yield", "yield_kg_per_ha", (0.0, None)),
+    "Soil_pH": ("soil", "soil_pH", (0.0, 14.0)),
+    "P": ("soil", "soil_P_mg_per_kg", (0.0, None)),
+    "K": ("soil", "soil_K_mg_per_kg", (0.0, None)),
+    "Ca": ("soil", "soil_Ca_mg_per_kg", (0.0, None)),
+    "Mg": ("soil", "soil_Mg_mg_per_kg", (0.0, None)),
+    "CEC": ("soil", "soil_CEC", (0.0, None)),
+    "OM": ("soil", "soil_OM_pct", (0.0, 100.0)),
+    "TotalPrecip_mm": ("weather", "totalPrecip_mm", (0.0, None)),
+    "AvgTmax_C": ("weather", "avgTmax_C", (-60.0, 60.0)),
+    "AvgTmin_C": ("weather", "avgTmin_C", (-60.0, 60.0)),
+}
+
+# record -> (slug prefix, class)
+RECORDS = {
+    "yield": ("yield", "YieldRecord"),
+    "soil": ("soil", "SoilMeasurement"),
+    "weather": ("weather", "WeatherSummary"),
+}
 
 
 # -------------------------------------------------------------------
 # Helpers
 # -------------------------------------------------------------------
 
+_SLUG_RUN = re.compile(r"[^a-z0-9]+")
+
+# Local names that can be written as :name in Turtle.
+_LOCAL_NAME = re.compile(r"^[A-Za-z0-9_](?:[A-Za-z0-9_.\-]*[A-Za-z0-9_\-])?$")
+
+_TTL_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r"})
+
+
+def slug_part(value: str) -> str:
+    """Lowercase, alnum runs joined by single underscores; may be empty."""
+    return _SLUG_RUN.sub("_", value.strip().lower()).strip("_")
+
+
 def slugify(value: str) -> str:
     """Generate a safe URI fragment: lowercase, alnum + underscore."""
-    value = (value or "").strip().lower()
-    value = re.sub(r"[^a-z0-9]+", "_", value)
-    value = re.sub(r"_+", "_", value).strip("_")
-    return value or "unnamed"
-
-
-def to_float(val: str):
-    if val is None:
-        return None
-    val = val.strip()
-    if not val:
-        return None
+    return slug_part(value or "") or "unnamed"
+
+
+def map_unique(func, column):
+    """func applied to every cell, but called once per distinct value."""
+    table = {value: func(value) for value in set(column)}
+    return [table[value] for value in column]
+
+
+def parse_float(lo=None, hi=None):
+    """Cell parser returning (float or None, error message or None)."""
+    def parse(text):
+        if not text:
+            return None, None
+        try:
+            value = float(text)
+        except ValueError:
+            return None, "not a number"
+        if not math.isfinite(value):
+            return None, "not a finite number"
+        if lo is not None and value < lo:
+            return None, f"below {lo:g}"
+        if hi is not None and value > hi:
+            return None, f"above {hi:g}"
+        return value, None
+    return parse
+
+
+def parse_bool_01(text):
+    if not text:
+        return None, None
+    if text in {"1", "true", "True"}:
+        return True, None
+    if text in {"0", "false", "False"}:
+        return False, None
+    return None, "expected 0/1 or true/false"
+
+
+def parse_year(text):
     try:
-        return float(val)
+        year = int(text)
     except ValueError:
-        return None
-
-
-def to_bool_from_01(val: str):
-    if val is None:
-        return None
-    val = val.strip()
-    if not val:
-        return None
-    if val in {"1", "true", "True"}:
-        return True
-    if val in {"0", "false", "False"}:
-        return False
-    return None
+        return None, "Year is not an integer"
+    if not YEAR_RANGE[0] <= year <= YEAR_RANGE[1]:
+        return None, f"Year outside {YEAR_RANGE}"
+    return year, None
+
+
+def sf_term(local: str) -> str:
+    if _LOCAL_NAME.match(local):
+        return ":" + local
+    return "<" + BASE_URI + local + ">"
+
+
+def string_literal(value: str) -> str:
+    return '"' + value.translate(_TTL_ESCAPES) + '"^^xsd:string'
+
+
+def float_literal(value) -> str:
+    return None if value is None else f'"{value!r}"^^xsd:float'
+
+
+def read_columns(path):
+    """
+    ([file line number of each data row], {header: [stripped cell, ...]})
+    for a CSV file. Line numbers count from 1, header included.
+    """
+    rows, lines = [], []
+    with path.open(newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)  # default delimiter=","
+        header = [name.strip() for name in next(reader, [])]
+        start = reader.line_num + 1
+        for r in reader:
+            # Blank lines are not records (csv.DictReader skipped them too).
+            if any(cell.strip() for cell in r):
+                rows.append(r)
+                lines.append(start)
+            start = reader.line_num + 1
+    width = len(header)
+    rows = [r if len(r) >= width else r + [""] * (width - len(r)) for r in rows]
+    columns = list(zip(*rows)) if rows else [() for _ in header]
+    return lines, {
+        name: map_unique(str.strip, column) for name, column in zip(header, columns)
+    }
 
 
 # -------------------------------------------------------------------
@@ -83,172 +201,147 @@ g.bind("", SF)
 
 
 # -------------------------------------------------------------------
-# Registries to avoid duplicate individuals
+# Parse + validate CSV columns
 # -------------------------------------------------------------------
 
-plots = {}       # PlotID -> URIRef
-crops = {}       # crop name -> URIRef
-treatments = {}  # treatment code -> URIRef
-
-
-def get_plot(plot_id: str) -> URIRef:
-    """Return (and create if needed) a Plot individual for PlotID."""
-    if plot_id in plots:
-        return plots[plot_id]
-    uri = SF[plot_id]
-    g.add((uri, RDF.type, SF.Plot))
-    g.add((uri, SF.hasPlotID, Literal(plot_id, datatype=XSD.string)))
-    plots[plot_id] = uri
-    return uri
-
-
-def get_crop(crop_name: str) -> URIRef:
-    """Return (and create if needed) a Crop individual based on crop name."""
-    if crop_name in crops:
-        return crops[crop_name]
-
-    slug = "crop_" + slugify(crop_name)
-    uri = SF[slug]
-    g.add((uri, RDF.type, SF.Crop))
-    g.add((uri, SF.hasCropName, Literal(crop_name, datatype=XSD.string)))
-    crops[crop_name] = uri
-    return uri
-
-
-def get_treatment(treatment_code: str) -> URIRef:
-    """Return (and create if needed) a Treatment individual based on code."""
-    if treatment_code in treatments:
-        return treatments[treatment_code]
-
-    slug = "treatment_" + slugify(treatment_code)
-    uri = SF[slug]
-    g.add((uri, RDF.type, SF.Treatment))
-    g.add((uri, RDFS.label, Literal(treatment_code, datatype=XSD.string)))
-    treatments[treatment_code] = uri
-    return uri
+lines, columns = read_columns(CSV_PATH)
+n_rows = len(lines)
+
+
+def column(name):
+    return columns.get(name) or [""] * n_rows
+
+
+errors = []          # (CSV line, column, value, problem)
+keep = [True] * n_rows
+
+
+def reject(i, name, value, problem):
+    errors.append((lines[i], name, value, problem))
+    keep[i] = False
+
+
+years = column("Year")
+plot_ids = column("PlotID")
+treatment_codes = column("Treatment")
+replicates = column("Replicate")
+crop_names = column("Crop")
+
+for i, (year, parsed) in enumerate(zip(years, map_unique(parse_year, years))):
+    if not year:
+        reject(i, "Year", year, "missing Year")
+    elif parsed[1]:
+        reject(i, "Year", year, parsed[1])
+
+plot_ok = map_unique(lambda pid: bool(_LOCAL_NAME.match(pid)), plot_ids)
+for i, pid in enumerate(plot_ids):
+    if not pid:
+        reject(i, "PlotID", pid, "missing PlotID")
+    elif not plot_ok[i]:
+        reject(i, "PlotID", pid, "PlotID cannot be used in a URI")
+
+# Record slug: <prefix>_<year>_<plot>_<replicate>, from per-value slugs.
+record_keys = [
+    "_".join(part for part in parts if part)
+    for parts in zip(
+        map_unique(slug_part, years),
+        map_unique(slug_part, plot_ids),
+        map_unique(lambda rep: slug_part(rep or "no_rep"), replicates),
+    )
+]
+seen_keys = {}
+for i, key in enumerate(record_keys):
+    if not keep[i]:
+        continue
+    if key in seen_keys:
+        reject(i, "Year/PlotID/Replicate", key, f"duplicate of line {lines[seen_keys[key]]}")
+    else:
+        seen_keys[key] = i
+
+float_values = {}    # column -> [Turtle literal or None, ...]
+for name, (_, _, (lo, hi)) in FLOAT_COLUMNS.items():
+    cells = column(name)
+    parsed = map_unique(parse_float(lo, hi), cells)
+    for i, (value, problem) in enumerate(parsed):
+        if problem and keep[i]:
+            errors.append((lines[i], name, cells[i], problem))
+    float_values[name] = map_unique(float_literal, [value for value, _ in parsed])
+
+soil_cells = column("Soil_Measured")
+soil_measured = map_unique(parse_bool_01, soil_cells)
+for i, (value, problem) in enumerate(soil_measured):
+    if problem and keep[i]:
+        errors.append((lines[i], "Soil_Measured", soil_cells[i], problem))
 
 
 # -------------------------------------------------------------------
-# Process CSV -> instances
+# Build instance Turtle
 # -------------------------------------------------------------------
 
-with CSV_PATH.open(newline="", encoding="utf-8") as f:
-    reader = csv.DictReader(f)  # default delimiter=","
-    for idx, row in enumerate(reader, start=1):
-        year = (row.get("Year") or "").strip()
-        plot_id = (row.get("PlotID") or "").strip()
-        treatment_code = (row.get("Treatment") or "").strip()
-        replicate = (row.get("Replicate") or "").strip()
-        crop_name = (row.get("Crop") or "").strip()
-
-        if not year or not plot_id:
-            print(f"Skipping row {idx}: missing Year or PlotID")
-            continue
-
-        plot_uri = get_plot(plot_id)
-        crop_uri = get_crop(crop_name) if crop_name else None
-        treatment_uri = get_treatment(treatment_code) if treatment_code else None
-
-        # ----------------------------------------------------------------
-        # YieldRecord individual
-        # ----------------------------------------------------------------
-        yr_slug = f"yield_{year}_{plot_id}_{replicate or 'no_rep'}"
-        yr_uri = SF[slugify(yr_slug)]
-
-        g.add((yr_uri, RDF.type, SF.YieldRecord))
-        g.add((yr_uri, SF.aboutPlot, plot_uri))
-        if crop_uri:
-            g.add((yr_uri, SF.forCrop, crop_uri))
-        if treatment_uri:
-            g.add((yr_uri, SF.withTreatment, treatment_uri))
-        if year:
-            g.add((yr_uri, SF.hasYear, Literal(year, datatype=XSD.gYear)))
-        if replicate:
-            g.add((yr_uri, SF.hasReplicate, Literal(replicate, datatype=XSD.string)))
-
-        yld = to_float(row.get("Yield_kg_ha"))
-        if yld is not None:
-            g.add((yr_uri, SF.yield_kg_per_ha, Literal(yld, datatype=XSD.float)))
-
-        # ----------------------------------------------------------------
-        # SoilMeasurement individual
-        # ----------------------------------------------------------------
-        sm_slug = f"soil_{year}_{plot_id}_{replicate or 'no_rep'}"
-        sm_uri = SF[slugify(sm_slug)]
-
-        g.add((sm_uri, RDF.type, SF.SoilMeasurement))
-        g.add((sm_uri, SF.aboutPlot, plot_uri))
-        if crop_uri:
-            g.add((sm_uri, SF.forCrop, crop_uri))
-        if year:
-            g.add((sm_uri, SF.hasYear, Literal(year, datatype=XSD.gYear)))
-        if replicate:
-            g.add((sm_uri, SF.hasReplicate, Literal(replicate, datatype=XSD.string)))
-
-        # Soil properties
-        val = to_float(row.get("Soil_pH"))
-        if val is not None:
-            g.add((sm_uri, SF.soil_pH, Literal(val, datatype=XSD.float)))
-
-        val = to_float(row.get("P"))
-        if val is not None:
-            g.add((sm_uri, SF.soil_P_mg_per_kg, Literal(val, datatype=XSD.float)))
-
-        val = to_float(row.get("K"))
-        if val is not None:
-            g.add((sm_uri, SF.soil_K_mg_per_kg, Literal(val, datatype=XSD.float)))
-
-        val = to_float(row.get("Ca"))
-        if val is not None:
-            g.add((sm_uri, SF.soil_Ca_mg_per_kg, Literal(val, datatype=XSD.float)))
-
-        val = to_float(row.get("Mg"))
-        if val is not None:
-            g.add((sm_uri, SF.soil_Mg_mg_per_kg, Literal(val, datatype=XSD.float)))
-
-        val = to_float(row.get("CEC"))
-        if val is not None:
-            g.add((sm_uri, SF.soil_CEC, Literal(val, datatype=XSD.float)))
-
-        val = to_float(row.get("OM"))
-        if val is not None:
-            g.add((sm_uri, SF.soil_OM_pct, Literal(val, datatype=XSD.float)))
-
-        sm_flag = to_bool_from_01(row.get("Soil_Measured"))
-        if sm_flag is not None:
-            g.add((sm_uri, SF.soilMeasured, Literal(sm_flag, datatype=XSD.boolean)))
-
-        # ----------------------------------------------------------------
-        # WeatherSummary individual
-        # ----------------------------------------------------------------
-        ws_slug = f"weather_{year}_{plot_id}_{replicate or 'no_rep'}"
-        ws_uri = SF[slugify(ws_slug)]
-
-        g.add((ws_uri, RDF.type, SF.WeatherSummary))
-        g.add((ws_uri, SF.aboutPlot, plot_uri))
-        if crop_uri:
-            g.add((ws_uri, SF.forCrop, crop_uri))
-        if year:
-            g.add((ws_uri, SF.hasYear, Literal(year, datatype=XSD.gYear)))
-        if replicate:
-            g.add((ws_uri, SF.hasReplicate, Literal(replicate, datatype=XSD.string)))
-
-        val = to_float(row.get("TotalPrecip_mm"))
-        if val is not None:
-            g.add((ws_uri, SF.totalPrecip_mm, Literal(val, datatype=XSD.float)))
-
-        val = to_float(row.get("AvgTmax_C"))
-        if val is not None:
-            g.add((ws_uri, SF.avgTmax_C, Literal(val, datatype=XSD.float)))
-
-        val = to_float(row.get("AvgTmin_C"))
-        if val is not None:
-            g.add((ws_uri, SF.avgTmin_C, Literal(val, datatype=XSD.float)))
+rows = [i for i in range(n_rows) if keep[i]]
+
+plot_terms = map_unique(sf_term, plot_ids)
+year_literals = map_unique(lambda y: f'"{y}"^^xsd:gYear', years)
+replicate_literals = map_unique(lambda r: string_literal(r) if r else None, replicates)
+crop_terms = map_unique(lambda c: sf_term("crop_" + slugify(c)) if c else None, crop_names)
+treatment_terms = map_unique(
+    lambda t: sf_term("treatment_" + slugify(t)) if t else None, treatment_codes)
+
+blocks = []
+
+# Plots, crops and treatments: one individual each, in first-seen order.
+for pid in dict.fromkeys(plot_ids[i] for i in rows):
+    blocks.append(f"{sf_term(pid)} a :Plot ;\n    :hasPlotID {string_literal(pid)} .")
+for name in dict.fromkeys(crop_names[i] for i in rows if crop_names[i]):
+    blocks.append(f"{sf_term('crop_' + slugify(name))} a :Crop ;\n"
+                  f"    :hasCropName {string_literal(name)} .")
+for code in dict.fromkeys(treatment_codes[i] for i in rows if treatment_codes[i]):
+    blocks.append(f"{sf_term('treatment_' + slugify(code))} a :Treatment ;\n"
+                  f"    rdfs:label {string_literal(code)} .")
+
+for i in rows:
+    common = [(":aboutPlot", plot_terms[i])]
+    for record, (prefix, cls) in RECORDS.items():
+        props = list(common)
+        if crop_terms[i]:
+            props.append((":forCrop", crop_terms[i]))
+        if record == "yield" and treatment_terms[i]:
+            props.append((":withTreatment", treatment_terms[i]))
+        props.append((":hasYear", year_literals[i]))
+        if replicate_literals[i]:
+            props.append((":hasReplicate", replicate_literals[i]))
+        for name, (kind, prop, _) in FLOAT_COLUMNS.items():
+            if kind == record and float_values[name][i] is not None:
+                props.append((":" + prop, float_values[name][i]))
+        if record == "soil" and soil_measured[i][0] is not None:
+            props.append((":soilMeasured", "true" if soil_measured[i][0] else "false"))
+
+        subject = sf_term(f"{prefix}_{record_keys[i]}")
+        blocks.append(f"{subject} a :{cls} ;\n    "
+                      + " ;\n    ".join(f"{p} {o}" for p, o in props) + " .")
+
 
 # -------------------------------------------------------------------
 # Serialize
 # -------------------------------------------------------------------
 
 OUTPUT_TTL.parent.mkdir(parents=True, exist_ok=True)
-g.serialize(destination=str(OUTPUT_TTL), format="turtle")
-print(f"Wrote instances to {OUTPUT_TTL}")
+with OUTPUT_TTL.open("w", encoding="utf-8") as out:
+    # Schema through rdflib; instances are written directly (same triples
+    # as adding them to the graph, without the serializer's cost per triple).
+    out.write(g.serialize(format="turtle"))
+    out.write(f"\n@prefix : <{BASE_URI}> .\n")
+    out.write("@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .\n")
+    out.write(f"@prefix xsd: <{XSD_URI}> .\n\n")
+    out.write("\n\n".join(blocks))
+    out.write("\n")
+print(f"Wrote instances to {OUTPUT_TTL} ({len(rows)} of {n_rows} rows)")
+
+if errors:
+    with ERRORS_CSV.open("w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["line", "column", "value", "problem"])
+        writer.writerows(sorted(errors, key=lambda e: e[0]))
+    print(f"{len(errors)} problems ({n_rows - len(rows)} rows skipped), see {ERRORS_CSV}")
+elif ERRORS_CSV.exists():
+    ERRORS_CSV.unlink()  # report from an earlier run
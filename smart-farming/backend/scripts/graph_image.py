@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Compact, read-only, memory-mapped image of an rdflib graph.
+
+One process parses the ontology + instances and writes the image; every
+other process maps the same file and shares its pages through the OS
+page cache instead of holding its own parsed copy.
+
+File layout (native byte order, all offsets 4-byte aligned):
+
+    header      MAGIC, graph version, term count, triple count
+    term index  uint32[n_terms + 1]  byte offsets into the term blob
+    term blob   N3 text of every term, sorted, so id lookup is a bisect
+    SPO         uint32[3 * n_triples] triples sorted by (s, p, o)
+    POS         uint32[3 * n_triples] sorted by (p, o, s)
+    OSP         uint32[3 * n_triples] sorted by (o, s, p)
+
+Usage:
+    python scripts/graph_image.py [output path]
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import sys
+from array import array
+from functools import lru_cache
+from pathlib import Path
+
+from rdflib import Graph
+from rdflib.store import Store
+from rdflib.util import from_n3
+
+MAGIC = b"SFGRAPH1"
+HEADER = struct.Struct("=8s32sII")
+
+# Decoded terms kept per process. Bounded so a worker does not slowly
+# rebuild a private copy of the whole graph as Python objects.
+TERM_CACHE_SIZE = 4096
+
+# (name, positions of s/p/o in the stored key order)
+ORDERS = [
+    ("spo", (0, 1, 2)),
+    ("pos", (1, 2, 0)),
+    ("osp", (2, 0, 1)),
+]
+
+
+def _pad4(n):
+    return (4 - n % 4) % 4
+
+
+def write_image(graph, path, version):
+    """Serialize `graph` to `path` atomically (write to temp, then rename)."""
+    terms = sorted({t.n3() for triple in graph for t in triple})
+    term_id = {t: i for i, t in enumerate(terms)}
+
+    encoded = [t.encode("utf-8") for t in terms]
+    offsets = array("I", [0])
+    for raw in encoded:
+        offsets.append(offsets[-1] + len(raw))
+    blob = b"".join(encoded)
+
+    ids = [
+        (term_id[s.n3()], term_id[p.n3()], term_id[o.n3()])
+        for s, p, o in graph
+    ]
+
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + f".tmp{os.getpid()}")
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, version.encode("ascii")[:32], len(terms), len(ids)))
+        f.write(offsets.tobytes())
+        f.write(blob + b"\0" * _pad4(len(blob)))
+        for _, key in ORDERS:
+            flat = array("I")
+            for triple in sorted(tuple(t[k] for k in key) for t in ids):
+                flat.extend(triple)
+            f.write(flat.tobytes())
+    os.replace(tmp, path)
+
+
+def image_version(path):
+    """Graph version recorded in an image, or None if missing/unreadable."""
+    try:
+        with open(path, "rb") as f:
+            magic, version, _, _ = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC:
+        return None
+    return version.rstrip(b"\0").decode("ascii")
+
+
+class MappedGraphStore(Store):
+    """Read-only rdflib store over a memory-mapped graph image."""
+
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = str(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_terms, n_triples = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a graph image")
+        self.version = version.rstrip(b"\0").decode("ascii")
+        self.n_terms = n_terms
+        self.n_triples = n_triples
+
+        view = memoryview(self._mm)
+        pos = HEADER.size
+        self._offsets = view[pos:pos + 4 * (n_terms + 1)].cast("I")
+        pos += 4 * (n_terms + 1)
+        blob_len = self._offsets[n_terms]
+        self._blob = view[pos:pos + blob_len]
+        pos += blob_len + _pad4(blob_len)
+        self._index = {}
+        for name, key in ORDERS:
+            self._index[name] = (view[pos:pos + 12 * n_triples].cast("I"), key)
+            pos += 12 * n_triples
+
+        self._namespace = {}
+        self._prefix = {}
+        # Bound methods so each store keeps its own cache.
+        self._term = lru_cache(maxsize=TERM_CACHE_SIZE)(self._decode)
+        self._id = lru_cache(maxsize=TERM_CACHE_SIZE)(self._lookup)
+
+    # -- terms ---------------------------------------------------------
+    def _text(self, i):
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]]).decode("utf-8")
+
+    def _decode(self, i):
+        return from_n3(self._text(i))
+
+    def _lookup(self, n3):
+        """Term id for an N3 string, or None if the term is not in the image."""
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._text(mid) < n3:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_terms and self._text(lo) == n3:
+            return lo
+        return None
+
+    # -- triple lookup -------------------------------------------------
+    @staticmethod
+    def _range(flat, lo, hi, col, value):
+        """Rows in [lo, hi) whose column `col` equals value (rows are sorted)."""
+        a, b = lo, hi
+        while a < b:
+            mid = (a + b) // 2
+            if flat[3 * mid + col] < value:
+                a = mid + 1
+            else:
+                b = mid
+        start = a
+        b = hi
+        while a < b:
+            mid = (a + b) // 2
+            if flat[3 * mid + col] <= value:
+                a = mid + 1
+            else:
+                b = mid
+        return start, a
+
+    def _match_ids(self, s, p, o):
+        bound = (s is not None, p is not None, o is not None)
+        if bound[0] and not bound[1] and bound[2]:
+            name = "osp"
+        elif bound[0]:
+            name = "spo"
+        elif bound[1]:
+            name = "pos"
+        elif bound[2]:
+            name = "osp"
+        else:
+            name = "spo"
+        flat, key = self._index[name]
+        wanted = (s, p, o)
+        lo, hi = 0, self.n_triples
+        for col, pos in enumerate(key):
+            if wanted[pos] is None:
+                break
+            lo, hi = self._range(flat, lo, hi, col, wanted[pos])
+            if lo == hi:
+                return
+        for row in range(lo, hi):
+            ordered = flat[3 * row:3 * row + 3]
+            triple = [0, 0, 0]
+            for col, pos in enumerate(key):
+                triple[pos] = ordered[col]
+            yield triple
+
+    def triples(self, triple_pattern, context=None):
+        ids = []
+        for term in triple_pattern:
+            if term is None:
+                ids.append(None)
+                continue
+            i = self._id(term.n3())
+            if i is None:
+                return
+            ids.append(i)
+        term = self._term
+        for s, p, o in self._match_ids(*ids):
+            yield (term(s), term(p), term(o)), iter(())
+
+    def __len__(self, context=None):
+        return self.n_triples
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    # -- namespaces (per process, not stored in the image) -------------
+    def bind(self, prefix, namespace, override=True, replace=False):
+        if not override and prefix in self._namespace:
+            return
+        self._namespace[prefix] = namespace
+        self._prefix[namespace] = prefix
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace)
+
+    def namespaces(self):
+        return iter(list(self._namespace.items()))
+
+    # -- read-only -----------------------------------------------------
+    def add(self, triple, context, quoted=False):
+        raise TypeError("Graph image is read-only")
+
+    def addN(self, quads):
+        raise TypeError("Graph image is read-only")
+
+    def remove(self, triple, context=None):
+        raise TypeError("Graph image is read-only")
+
+
+def attach_or_build(path, sources, version, identifier=None):
+    """
+    Return a Graph backed by the image at `path`, building it first if it is
+    missing or stale. A file lock makes sure only one process builds; the
+    others wait for it and then attach to the finished file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path) + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if image_version(path) != version:
+                print(f"Building graph image {path} ...")
+                graph = Graph()
+                graph.parse(sources[0])
+                for source in sources[1:]:
+                    graph.parse(source, format="turtle")
+                write_image(graph, path, version)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return Graph(store=MappedGraphStore(path), identifier=identifier)
+
+
+if __name__ == "__main__":
+    # Building is what query_service does on import when SF_GRAPH_IMAGE is set.
+    backend = Path(__file__).resolve().parent.parent
+    out = Path(sys.argv[1]) if len(sys.argv) > 1 else backend / "ontology" / "graph.img"
+    os.environ["SF_GRAPH_IMAGE"] = str(out.resolve())
+    sys.path.insert(0, str(backend))
+    import scripts.query_service  # noqa: F401
+
+    print(f"Graph image ready at {out}")
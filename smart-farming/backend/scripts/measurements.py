@@ -0,0 +1,178 @@
+"""
+Columnar store for the numeric measurement values of a farm graph.
+
+Every YieldRecord / SoilMeasurement / WeatherSummary subject is interned
+to a row number. Numeric properties live in one `array('d')` column each
+(NaN = missing), and plot and year are kept as integer columns. Once the
+columns are filled, the numeric triples can be removed from the rdflib
+graph, which then only keeps structure: types, plots, crops, treatments
+and years. Queries read plain floats from the columns instead of boxing
+and unboxing a Literal per value.
+"""
+
+import math
+from array import array
+
+from rdflib import Literal
+from rdflib.namespace import RDF, XSD
+
+NAN = float("nan")
+
+
+class MeasurementStore:
+    """
+    kinds:      {kind name: rdf:type URIRef}; a row's `kind` column is a
+                bit mask over these, in order
+    properties: {column name: predicate URIRef}
+    """
+
+    def __init__(self, kinds, properties):
+        self.kind_bits = {name: 1 << i for i, name in enumerate(kinds)}
+        self.kind_types = dict(kinds)
+        self.properties = dict(properties)
+        self.column_of = {predicate: name for name, predicate in self.properties.items()}
+        self.stripped = False       # True once the triples are out of the graph
+
+        self.subjects = []          # row -> subject URIRef
+        self.row_of = {}            # subject -> row
+        self.kind = array("B")      # row -> kind bit mask
+        self.year = array("i")      # row -> year, 0 if unknown
+        self.plot = array("i")      # row -> index into self.plots, -1 if none
+        self.columns = {name: array("d") for name in self.properties}
+
+        self.plots = []             # plot index -> plot URIRef
+        self.plot_index = {}        # plot URIRef -> plot index
+        self.plot_ids = []          # plot index -> hasPlotID string (or None)
+        self.rows_by_plot = {}      # plot index -> [row, ...]
+
+    # -- building ------------------------------------------------------
+    @classmethod
+    def from_graph(cls, graph, kinds, properties, about, year, plot_id, strip=False):
+        """
+        Load the store from `graph`. `about`, `year` and `plot_id` are the
+        predicates linking a record to its plot, its year and a plot to its
+        ID. With strip=True the numeric triples of the interned records are
+        removed from the graph; values on any other subject stay there.
+        """
+        store = cls(kinds, properties)
+        for name, rdf_type in store.kind_types.items():
+            bit = store.kind_bits[name]
+            for subject in graph.subjects(RDF.type, rdf_type):
+                store._row(subject, graph, about, year, plot_id)
+                store.kind[store.row_of[subject]] |= bit
+
+        for name, predicate in store.properties.items():
+            column = store.columns[name]
+            held = []   # triples now answered by the column
+            for subject, value in graph.subject_objects(predicate):
+                row = store.row_of.get(subject)
+                if row is None:
+                    continue  # not a record: stays in the graph
+                if math.isnan(column[row]):
+                    try:
+                        column[row] = float(value)
+                    except (TypeError, ValueError):
+                        continue  # not a number: stays in the graph
+                # else a repeated value: only the first is kept
+                held.append((subject, predicate, value))
+            if strip:
+                for triple in held:
+                    graph.remove(triple)
+        store.stripped = strip
+        return store
+
+    def _row(self, subject, graph, about, year, plot_id):
+        if subject in self.row_of:
+            return self.row_of[subject]
+        row = len(self.subjects)
+        self.subjects.append(subject)
+        self.row_of[subject] = row
+        self.kind.append(0)
+
+        y = graph.value(subject, year)
+        try:
+            self.year.append(int(str(y)) if y is not None else 0)
+        except ValueError:
+            self.year.append(0)
+
+        plot = graph.value(subject, about)
+        if plot is None:
+            self.plot.append(-1)
+        else:
+            idx = self.plot_index.get(plot)
+            if idx is None:
+                idx = self.plot_index[plot] = len(self.plots)
+                self.plots.append(plot)
+                pid = graph.value(plot, plot_id)
+                self.plot_ids.append(str(pid) if pid is not None else None)
+            self.plot.append(idx)
+            self.rows_by_plot.setdefault(idx, []).append(row)
+
+        for column in self.columns.values():
+            column.append(NAN)
+        return row
+
+    # -- reading -------------------------------------------------------
+    def __len__(self):
+        return len(self.subjects)
+
+    def value(self, row, name):
+        """Float value of a column for a row, or None if missing."""
+        v = self.columns[name][row]
+        return None if math.isnan(v) else v
+
+    def is_kind(self, row, kind):
+        return bool(self.kind[row] & self.kind_bits[kind])
+
+    def rows(self, kind=None, plot=None):
+        """Row numbers, optionally of one kind and/or about one plot URIRef."""
+        if plot is not None:
+            idx = self.plot_index.get(plot)
+            candidates = self.rows_by_plot.get(idx, []) if idx is not None else []
+        else:
+            candidates = range(len(self.subjects))
+        if kind is None:
+            return list(candidates)
+        bit = self.kind_bits[kind]
+        return [r for r in candidates if self.kind[r] & bit]
+
+    def plot_id(self, row):
+        """hasPlotID of the row's plot, or None."""
+        idx = self.plot[row]
+        return self.plot_ids[idx] if idx >= 0 else None
+
+    def triples(self, subject=None, predicate=None, obj=None):
+        """
+        Stored values matching a triple pattern as (subject, predicate,
+        xsd:float Literal), standing in for the triples removed by strip.
+        Only the first value of a repeated property is kept.
+        """
+        if predicate is None:
+            names = list(self.properties)
+        elif predicate in self.column_of:
+            names = [self.column_of[predicate]]
+        else:
+            return
+        if obj is not None and not isinstance(obj, Literal):
+            return
+        if subject is None:
+            rows = range(len(self.subjects))
+        elif subject in self.row_of:
+            rows = [self.row_of[subject]]
+        else:
+            return
+        for name in names:
+            column = self.columns[name]
+            predicate = self.properties[name]
+            for r in rows:
+                v = column[r]
+                if math.isnan(v):
+                    continue
+                value = Literal(v, datatype=XSD.float)
+                if obj is None or value == obj:
+                    yield self.subjects[r], predicate, value
+
+    def nbytes(self):
+        """Approximate size of the typed columns."""
+        arrays = [self.kind, self.year, self.plot, *self.columns.values()]
+        return sum(a.itemsize * len(a) for a in arrays)
@@ -1,168 +1,276 @@
+import hashlib
+import os
+import math
+import time
+from bisect import bisect_left
 from pathlib import Path
-from rdflib import Graph, Namespace, Literal
-from rdflib.namespace import RDF
+from threading import Lock, Thread
+from rdflib import Graph, Namespace, URIRef
+from rdflib.namespace import RDF, RDFS, XSD
+from rdflib.store import Store
+
+from scripts.adhoc_sparql import (
+    PLANS as SPARQL_PLANS, LRUCache, execute as execute_sparql, prepare as prepare_sparql,
+    result_nbytes as sparql_result_nbytes,
+)
+from scripts.analogs import AnalogIndex
+from scripts.diagnostics import deep_sizeof, triple_counts
+from scripts.events import EventHub
+from scripts.graph_image import MappedGraphStore, attach_or_build
+from scripts.measurements import MeasurementStore
+from scripts.tenants import DatasetPool, UnknownFarmError
+from scripts.yield_cube import YieldCube, DIMENSIONS as YIELD_DIMENSIONS
 
 BASE_URI = "http://example.org/smart-farming#"
 SF = Namespace(BASE_URI)
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-g = Graph()
-g.parse(BASE_DIR / "ontology" / "smart-farming-backup.owl")
-g.parse(BASE_DIR / "ontology" / "instances.ttl", format="turtle")
-
-g.bind("sf", SF)
-g.bind("", SF)
-
-from threading import Lock
-QUERY_LOCK = Lock()
-
-# ---------------------------------------------------------------------
-# 1. Plot + year summary
-# ---------------------------------------------------------------------
-def get_plot_year_summary(plot_id: str, year: int):
-    # Query yield data
-    yield_query = f"""
-    PREFIX sf: <{BASE_URI}>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+ONTOLOGY_PATH = BASE_DIR / "ontology" / "smart-farming-backup.owl"
+
+# The original single-farm data set; other farms live in FARMS_DIR/<id>/instances.ttl
+DEFAULT_FARM = "default"
+FARMS_DIR = BASE_DIR / "farms"
+
+GRAPH_SOURCES = [
+    ONTOLOGY_PATH,
+    BASE_DIR / "ontology" / "instances.ttl",
+]
+
+# Multi-process serving: point SF_GRAPH_IMAGE at a file path and every
+# worker maps one shared read-only image instead of parsing its own copy.
+# Other farms get a sibling image named <stem>.<farm_id><suffix>.
+GRAPH_IMAGE = os.environ.get("SF_GRAPH_IMAGE")
+
+# Loaded farms are evicted least-recently-used beyond this estimate.
+TENANT_MEMORY_BUDGET = int(os.environ.get("SF_TENANT_MEMORY_MB", "512")) * 2**20
+
+# Rough resident cost of one triple in an in-memory rdflib graph, and of
+# one in a mapped image (the file pages themselves are shared).
+BYTES_PER_TRIPLE = 1300
+BYTES_PER_MAPPED_TRIPLE = 64
+
+
+# Record classes interned by the measurement store, and the numeric
+# properties it holds as typed columns instead of Literal triples.
+MEASUREMENT_KINDS = {
+    "yield": SF.YieldRecord,
+    "soil": SF.SoilMeasurement,
+    "weather": SF.WeatherSummary,
+}
+MEASUREMENT_PROPERTIES = {
+    name: SF[name]
+    for name in (
+        "yield_kg_per_ha",
+        "soil_pH", "soil_P_mg_per_kg", "soil_K_mg_per_kg", "soil_Ca_mg_per_kg",
+        "soil_Mg_mg_per_kg", "soil_N_mg_per_kg", "soil_CEC", "soil_OM_pct",
+        "totalPrecip_mm", "avgTmax_C", "avgTmin_C", "forecastRainfallAmount_mm",
+    )
+}
+
+
+def compute_graph_version(paths) -> str:
+    """Content hash of the files the graph is loaded from (used for ETags)."""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(Path(path).name.encode("utf-8"))
+        digest.update(Path(path).read_bytes())
+    return digest.hexdigest()[:20]
+
+
+def source_signature(paths):
+    """Cheap (path, mtime, size) check for whether the source files changed."""
+    signature = []
+    for path in paths:
+        try:
+            st = Path(path).stat()
+            signature.append((str(path), st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append((str(path), None, None))
+    return tuple(signature)
+
+
+def farm_sources(farm_id: str):
+    """Ontology + instance files for a farm; UnknownFarmError if it has none."""
+    if farm_id == DEFAULT_FARM:
+        return GRAPH_SOURCES
+    instances = FARMS_DIR / farm_id / "instances.ttl"
+    if not instances.is_file():
+        raise UnknownFarmError(farm_id)
+    return [ONTOLOGY_PATH, instances]
+
+
+def list_farms():
+    farms = [DEFAULT_FARM]
+    if FARMS_DIR.is_dir():
+        farms += sorted(
+            d.name for d in FARMS_DIR.iterdir() if (d / "instances.ttl").is_file()
+        )
+    return farms
 
-    SELECT ?y ?yield ?cropName ?treatmentCode
-    WHERE {{
-      sf:{plot_id} a sf:Plot .
 
-      ?yr a sf:YieldRecord ;
-          sf:aboutPlot sf:{plot_id} ;
-          sf:hasYear ?y ;
-          sf:yield_kg_per_ha ?yield .
-
-      OPTIONAL {{
-        ?yr sf:forCrop ?crop .
-        ?crop sf:hasCropName ?cropName .
-      }}
-      
-      OPTIONAL {{
-        ?yr sf:withTreatment ?treat .
-        ?treat rdfs:label ?treatmentCode .
-      }}
-    }}
+class FarmDataset:
     """
+    One farm's graph (a named graph of its own) with its lock, version,
+    measurement columns and derived indexes. Nothing is shared between
+    farms; the indexes are built the first time they are used.
 
-    # Query soil data separately
-    soil_query = f"""
-    PREFIX sf: <{BASE_URI}>
-
-    SELECT ?y ?soil_pH ?P ?K ?Ca ?Mg ?CEC ?OM
-    WHERE {{
-      sf:{plot_id} a sf:Plot .
-
-      ?sm a sf:SoilMeasurement ;
-          sf:aboutPlot sf:{plot_id} ;
-          sf:hasYear ?y .
-
-      OPTIONAL {{ ?sm sf:soil_pH ?soil_pH }}
-      OPTIONAL {{ ?sm sf:soil_P_mg_per_kg ?P }}
-      OPTIONAL {{ ?sm sf:soil_K_mg_per_kg ?K }}
-      OPTIONAL {{ ?sm sf:soil_Ca_mg_per_kg ?Ca }}
-      OPTIONAL {{ ?sm sf:soil_Mg_mg_per_kg ?Mg }}
-      OPTIONAL {{ ?sm sf:soil_CEC ?CEC }}
-      OPTIONAL {{ ?sm sf:soil_OM_pct ?OM }}
-    }}
+    Numeric measurement values live in `measurements`. In a parsed graph
+    their triples are dropped after loading; a mapped image is read-only
+    and keeps them, but they are never read from it.
     """
 
-    # Query weather data separately
-    weather_query = f"""
-    PREFIX sf: <{BASE_URI}>
-
-    SELECT ?y ?precip ?tmax ?tmin
-    WHERE {{
-      sf:{plot_id} a sf:Plot .
+    def __init__(self, farm_id, sources):
+        self.farm_id = farm_id
+        self.sources = sources
+        # Taken before reading, so a write during loading is seen next time.
+        self.signature = source_signature(sources)
+        # Changes only when the ontology or instance files are regenerated.
+        self.version = compute_graph_version(sources)
+        identifier = URIRef(f"{BASE_URI}farm/{farm_id}")
+
+        if GRAPH_IMAGE:
+            image = Path(GRAPH_IMAGE)
+            if farm_id != DEFAULT_FARM:
+                image = image.with_name(f"{image.stem}.{farm_id}{image.suffix}")
+            self.graph = attach_or_build(image, sources, self.version, identifier)
+            per_triple = BYTES_PER_MAPPED_TRIPLE
+        else:
+            self.graph = Graph(identifier=identifier)
+            self.graph.parse(sources[0])
+            for source in sources[1:]:
+                self.graph.parse(source, format="turtle")
+            per_triple = BYTES_PER_TRIPLE
+
+        self.measurements = MeasurementStore.from_graph(
+            self.graph, MEASUREMENT_KINDS, MEASUREMENT_PROPERTIES,
+            about=SF.aboutPlot, year=SF.hasYear, plot_id=SF.hasPlotID,
+            strip=not GRAPH_IMAGE,
+        )
+        self.load_estimate = (
+            len(self.graph) * per_triple + self.measurements.nbytes()
+        )
 
-      ?ws a sf:WeatherSummary ;
-          sf:aboutPlot sf:{plot_id} ;
-          sf:hasYear ?y .
+        self.graph.bind("sf", SF)
+        self.graph.bind("", SF)
+
+        self.lock = Lock()
+        self._index_lock = Lock()
+        self._plot_history = None
+        self._season_index = None
+        self._yield_cube = None
+        self._analog_index = None
+        # Ad-hoc query results; dropped with the dataset when it is evicted.
+        self.sparql_results = LRUCache(SPARQL_RESULT_CACHE_SIZE, sizeof=sparql_result_nbytes)
+
+    @property
+    def memory_estimate(self):
+        """Bytes held for this farm: the loaded graph plus cached results."""
+        return self.load_estimate + self.sparql_results.nbytes
+
+    def _build_once(self, attr, build):
+        if getattr(self, attr) is None:
+            with self._index_lock:
+                if getattr(self, attr) is None:
+                    setattr(self, attr, build())
+        return getattr(self, attr)
+
+    @property
+    def plot_history(self):
+        return self._build_once(
+            "_plot_history", lambda: build_plot_history(self.graph))
+
+    @property
+    def season_index(self):
+        return self._build_once(
+            "_season_index", lambda: build_season_index(self.plot_history))
+
+    @property
+    def yield_cube(self):
+        return self._build_once(
+            "_yield_cube", lambda: YieldCube.build(load_yield_records(self)))
+
+    @property
+    def analog_index(self):
+        return self._build_once(
+            "_analog_index", lambda: build_analog_index(self))
+
+    def warm(self):
+        """Build every derived index now rather than on first request."""
+        for name in ("plot_history", "season_index", "yield_cube", "analog_index"):
+            getattr(self, name)
+        return self
+
+
+FARMS = DatasetPool(
+    lambda farm_id: FarmDataset(farm_id, farm_sources(farm_id)),
+    TENANT_MEMORY_BUDGET,
+)
+
+
+def get_dataset(farm: str = DEFAULT_FARM) -> FarmDataset:
+    """Loaded dataset for a farm (loading it if cold); UnknownFarmError if none."""
+    _start_reloader()
+    return FARMS.get(farm)
 
-      OPTIONAL {{ ?ws sf:totalPrecip_mm ?precip }}
-      OPTIONAL {{ ?ws sf:avgTmax_C ?tmax }}
-      OPTIONAL {{ ?ws sf:avgTmin_C ?tmin }}
-    }}
-    """
-
-    try:
-        with QUERY_LOCK:
-            yield_results = [row for row in g.query(yield_query)]
-            soil_results = [row for row in g.query(soil_query)]
-            weather_results = [row for row in g.query(weather_query)]
-    except Exception as e:
-        print(f"ERROR in get_plot_year_summary: {e}")
-        return None
 
-    print(f"DEBUG: plot={plot_id}, year={year}")
-    print(f"  yields: {len(yield_results)}, soils: {len(soil_results)}, weathers: {len(weather_results)}")
+# ---------------------------------------------------------------------
+# 1. Plot + year summary
+# ---------------------------------------------------------------------
+def get_plot_year_summary(plot_id: str, year: int, farm: str = DEFAULT_FARM):
+    ds = get_dataset(farm)
+    store = ds.measurements
+    plot = SF[plot_id]
+
+    with ds.lock:
+        if (plot, RDF.type, SF.Plot) not in ds.graph:
+            print(f"DEBUG: No plot {plot_id}")
+            return None
+        rows = [r for r in store.rows(plot=plot) if store.year[r] == year]
 
-    chosen_yield = None
-    for row in yield_results:
-        row_year = str(row[0]) if row[0] else ""
-        if row_year == str(year):
-            chosen_yield = row
-            break
+        # Yield for that year (records without a yield value don't count)
+        chosen_yield = None
+        for r in rows:
+            if store.is_kind(r, "yield") and store.value(r, "yield_kg_per_ha") is not None:
+                chosen_yield = r
+                break
 
-    if chosen_yield is None:
-        print(f"DEBUG: No yield for {plot_id}/{year}")
-        return None
+        if chosen_yield is None:
+            print(f"DEBUG: No yield for {plot_id}/{year}")
+            return None
 
-    # Find soil for same year
-    soil_data = None
-    for row in soil_results:
-        row_year = str(row[0]) if row[0] else ""
-        if row_year == str(year):
-            soil_data = {
-                "soil_pH": float(row[1]) if row[1] is not None else None,
-                "P": float(row[2]) if row[2] is not None else None,
-                "K": float(row[3]) if row[3] is not None else None,
-                "Ca": float(row[4]) if row[4] is not None else None,
-                "Mg": float(row[5]) if row[5] is not None else None,
-                "CEC": float(row[6]) if row[6] is not None else None,
-                "OM": float(row[7]) if row[7] is not None else None,
-            }
-            break
+        record = store.subjects[chosen_yield]
+        crop = ds.graph.value(record, SF.forCrop)
+        crop_name = ds.graph.value(crop, SF.hasCropName) if crop is not None else None
+        treat = ds.graph.value(record, SF.withTreatment)
+        treatment = ds.graph.value(treat, RDFS.label) if treat is not None else None
 
-    # Find weather for same year
-    weather_data = None
-    for row in weather_results:
-        row_year = str(row[0]) if row[0] else ""
-        if row_year == str(year):
-            weather_data = {
-                "precip": float(row[1]) if row[1] is not None else None,
-                "tmax": float(row[2]) if row[2] is not None else None,
-                "tmin": float(row[3]) if row[3] is not None else None,
-            }
-            break
+    # Soil and weather for the same year
+    soil = next((r for r in rows if store.is_kind(r, "soil")), None)
+    weather = next((r for r in rows if store.is_kind(r, "weather")), None)
 
-    def _to_float(x):
-        try:
-            return float(x) if x is not None else None
-        except:
-            return None
+    def _col(row, name):
+        return store.value(row, name) if row is not None else None
 
     return {
         "plot_id": plot_id,
         "year": year,
-        "yield_kg_per_ha": _to_float(chosen_yield[1]) if chosen_yield[1] is not None else None,
-        "crop_name": str(chosen_yield[2]) if chosen_yield[2] is not None else None,
-        "treatment": str(chosen_yield[3]) if chosen_yield[3] is not None else None,
+        "yield_kg_per_ha": store.value(chosen_yield, "yield_kg_per_ha"),
+        "crop_name": str(crop_name) if crop_name is not None else None,
+        "treatment": str(treatment) if treatment is not None else None,
         "soil": {
-            "pH": soil_data["soil_pH"] if soil_data else None,
-            "P_mg_per_kg": soil_data["P"] if soil_data else None,
-            "K_mg_per_kg": soil_data["K"] if soil_data else None,
-            "Ca_mg_per_kg": soil_data["Ca"] if soil_data else None,
-            "Mg_mg_per_kg": soil_data["Mg"] if soil_data else None,
-            "CEC": soil_data["CEC"] if soil_data else None,
-            "OM_pct": soil_data["OM"] if soil_data else None,
+            "pH": _col(soil, "soil_pH"),
+            "P_mg_per_kg": _col(soil, "soil_P_mg_per_kg"),
+            "K_mg_per_kg": _col(soil, "soil_K_mg_per_kg"),
+            "Ca_mg_per_kg": _col(soil, "soil_Ca_mg_per_kg"),
+            "Mg_mg_per_kg": _col(soil, "soil_Mg_mg_per_kg"),
+            "CEC": _col(soil, "soil_CEC"),
+            "OM_pct": _col(soil, "soil_OM_pct"),
         },
         "weather": {
-            "total_precip_mm": weather_data["precip"] if weather_data else None,
-            "avg_tmax_C": weather_data["tmax"] if weather_data else None,
-            "avg_tmin_C": weather_data["tmin"] if weather_data else None,
+            "total_precip_mm": _col(weather, "totalPrecip_mm"),
+            "avg_tmax_C": _col(weather, "avgTmax_C"),
+            "avg_tmin_C": _col(weather, "avgTmin_C"),
         },
     }
 
@@ -170,8 +278,9 @@ def get_plot_year_summary(plot_id: str, year: int):
 # ---------------------------------------------------------------------
 # 2. Utility: list all plots
 # ---------------------------------------------------------------------
-def list_plots():
+def list_plots(farm: str = DEFAULT_FARM):
     """Return a simple list of all plot IDs that exists."""
+    ds = get_dataset(farm)
     query = f"""
     PREFIX sf: <{BASE_URI}>
 
@@ -183,8 +292,8 @@ def list_plots():
     ORDER BY ?pid
     """
     try:
-        with QUERY_LOCK:
-            results = list(g.query(query))
+        with ds.lock:
+            results = list(ds.graph.query(query))
     except Exception as e:
         print("ERROR in list_plots:", e)
         return []
@@ -194,67 +303,66 @@ def list_plots():
 # ---------------------------------------------------------------------
 # 3. Needs fertilizer
 # ---------------------------------------------------------------------
-def get_plots_needing_fertilizer():
+def get_plots_needing_fertilizer(farm: str = DEFAULT_FARM):
     """
     Plots that look nutrient-limited (low yield OR low soil P OR low soil N).
     Returns a list of plot IDs.
     """
-    query = """
-    PREFIX sf: <{}>
-
-    SELECT DISTINCT ?pid ?y ?p ?n ?yield
-    WHERE {{
-      ?pl a sf:Plot ;
-          sf:hasPlotID ?pid .
-
-      # Any low-yield record on this plot
-      OPTIONAL {{
-        ?yr a sf:YieldRecord ;
-            sf:aboutPlot ?pl ;
-            sf:yield_kg_per_ha ?yield .
-        FILTER (?yield < 1111.0)
-      }}
-
-      # Any low soil P on this plot
-      OPTIONAL {{
-        ?smP a sf:SoilMeasurement ;
-             sf:aboutPlot ?pl ;
-             sf:soil_P_mg_per_kg ?p .
-        FILTER (?p < 15.0)
-      }}
-
-      # Any low soil N on this plot
-      OPTIONAL {{
-        ?smN a sf:SoilMeasurement ;
-             sf:aboutPlot ?pl ;
-             sf:soil_N_mg_per_kg ?n .
-        FILTER (?n < 10.0)
-      }}
-
-      # Require that at least one of these three conditions held
-      FILTER(BOUND(?yield) || BOUND(?p) || BOUND(?n))
-    }}
-    ORDER BY ?pid
-    """.format(BASE_URI)
-    try:
-        with QUERY_LOCK:
-            results = list(g.query(query))
-    except Exception as e:
-        print("ERROR in get_plots_needing_fertilizer:", e)
-        return []
+    ds = get_dataset(farm)
+    store = ds.measurements
+    yields = store.columns["yield_kg_per_ha"]
+    soil_p = store.columns["soil_P_mg_per_kg"]
+    soil_n = store.columns["soil_N_mg_per_kg"]
+
+    # NaN compares False, so missing values never qualify.
+    flagged = set()
+    for r in store.rows(kind="yield"):
+        if yields[r] < 1111.0:
+            flagged.add(r)
+    for r in store.rows(kind="soil"):
+        if soil_p[r] < 15.0 or soil_n[r] < 10.0:
+            flagged.add(r)
+
+    return sorted({
+        pid for pid in (_plot_pid(ds, r) for r in flagged) if pid is not None
+    })
+
+
+def _plot_pid(ds, row):
+    """hasPlotID of the sf:Plot a measurement row is about, else None."""
+    store = ds.measurements
+    idx = store.plot[row]
+    if idx < 0 or (store.plots[idx], RDF.type, SF.Plot) not in ds.graph:
+        return None
+    return store.plot_ids[idx]
 
-    rows = list(results)
-    print("DEBUG needs-fertilizer rows:", len(rows))
-    for r in rows[:5]:
-        print("  row:", r)
 
-    return sorted({str(row["pid"]) for row in rows})
+def _latest_per_plot(ds, kind, column, keep):
+    """
+    {plot_id: value} for rows of `kind` whose `column` passes keep(value).
+    When a plot has several, the most recent year wins (then the largest).
+    """
+    store = ds.measurements
+    values = store.columns[column]
+    best = {}
+    for r in store.rows(kind=kind):
+        v = values[r]
+        if math.isnan(v) or not keep(v):
+            continue
+        pid = _plot_pid(ds, r)
+        if pid is None:
+            continue
+        key = (store.year[r], v)
+        if pid not in best or key > best[pid]:
+            best[pid] = key
+    return {pid: v for pid, (_, v) in best.items()}
 
 
 # ---------------------------------------------------------------------
 # 4. Crop lookup
 # ---------------------------------------------------------------------
-def get_legume_crops():
+def get_legume_crops(farm: str = DEFAULT_FARM):
+    ds = get_dataset(farm)
     query = """
     PREFIX sf: <{}>
 
@@ -267,8 +375,8 @@ def get_legume_crops():
     ORDER BY ?name
     """.format(BASE_URI)
     try:
-        with QUERY_LOCK:
-            results = list(g.query(query))
+        with ds.lock:
+            results = list(ds.graph.query(query))
     except Exception as e:
         print("ERROR in get_legume_crops:", e)
         return []
@@ -279,7 +387,8 @@ def get_legume_crops():
     ]
 
 
-def get_cereal_crops():
+def get_cereal_crops(farm: str = DEFAULT_FARM):
+    ds = get_dataset(farm)
     query = """
     PREFIX sf: <{}>
 
@@ -292,8 +401,8 @@ def get_cereal_crops():
     ORDER BY ?name
     """.format(BASE_URI)
     try:
-        with QUERY_LOCK:
-            results = list(g.query(query))
+        with ds.lock:
+            results = list(ds.graph.query(query))
     except Exception as e:
         print("ERROR in get_cereal_crops:", e)
         return []
@@ -307,63 +416,15 @@ def get_cereal_crops():
 # ---------------------------------------------------------------------
 # 5. Postpone fertilizer (deduplicate per plot)
 # ---------------------------------------------------------------------
-def get_plots_to_postpone_fertilizer():
+def get_plots_to_postpone_fertilizer(farm: str = DEFAULT_FARM):
     """
     Plots where soil_P >= 15 AND rainfall > 650.
-    Query soil and weather separately then combine.
+    Read soil and weather columns separately then combine.
     """
-    soil_query = """
-    PREFIX sf: <{}>
-
-    SELECT DISTINCT ?pid ?p
-    WHERE {{
-      ?pl a sf:Plot ;
-          sf:hasPlotID ?pid .
-      
-      ?sm a sf:SoilMeasurement ;
-          sf:aboutPlot ?pl ;
-          sf:soil_P_mg_per_kg ?p .
-      
-      FILTER (?p >= 15.0)
-    }}
-    ORDER BY ?pid
-    """.format(BASE_URI)
-
-    rain_query = """
-    PREFIX sf: <{}>
-
-    SELECT DISTINCT ?pid ?rain
-    WHERE {{
-      ?pl a sf:Plot ;
-          sf:hasPlotID ?pid .
-      
-      ?ws a sf:WeatherSummary ;
-          sf:aboutPlot ?pl ;
-          sf:forecastRainfallAmount_mm ?rain .
-      
-      FILTER (?rain > 650.0)
-    }}
-    ORDER BY ?pid
-    """.format(BASE_URI)
-
-    try:
-        with QUERY_LOCK:
-            soil_results = list(g.query(soil_query))
-            rain_results = list(g.query(rain_query))
-    except Exception as e:
-        print("ERROR in get_plots_to_postpone_fertilizer:", e)
-        return []
-
-    # Build sets for efficient intersection
-    soil_plots = {}
-    for row in soil_results:
-        pid = str(row["pid"])
-        soil_plots[pid] = float(row["p"])
-
-    rain_plots = {}
-    for row in rain_results:
-        pid = str(row["pid"])
-        rain_plots[pid] = float(row["rain"])
+    ds = get_dataset(farm)
+    soil_plots = _latest_per_plot(ds, "soil", "soil_P_mg_per_kg", lambda p: p >= 15.0)
+    rain_plots = _latest_per_plot(
+        ds, "weather", "forecastRainfallAmount_mm", lambda rain: rain > 650.0)
 
     # Find intersection - plots with BOTH high P AND high rain
     result = []
@@ -381,7 +442,8 @@ def get_plots_to_postpone_fertilizer():
 # ---------------------------------------------------------------------
 # 6. High pest risk
 # ---------------------------------------------------------------------
-def get_plots_high_pest_risk():
+def get_plots_high_pest_risk(farm: str = DEFAULT_FARM):
+    ds = get_dataset(farm)
     # Get maize plots
     maize_query = """
     PREFIX sf: <{}>
@@ -402,47 +464,9 @@ def get_plots_high_pest_risk():
     ORDER BY ?pid
     """.format(BASE_URI)
 
-    # Get high rainfall plots
-    rain_query = """
-    PREFIX sf: <{}>
-
-    SELECT DISTINCT ?pid ?rain
-    WHERE {{
-      ?pl a sf:Plot ;
-          sf:hasPlotID ?pid .
-      
-      ?ws a sf:WeatherSummary ;
-          sf:aboutPlot ?pl ;
-          sf:forecastRainfallAmount_mm ?rain .
-      
-      FILTER (?rain > 950.0)
-    }}
-    ORDER BY ?pid
-    """.format(BASE_URI)
-
-    # Get low yield plots
-    yield_query = """
-    PREFIX sf: <{}>
-
-    SELECT DISTINCT ?pid ?y
-    WHERE {{
-      ?pl a sf:Plot ;
-          sf:hasPlotID ?pid .
-      
-      ?yr a sf:YieldRecord ;
-          sf:aboutPlot ?pl ;
-          sf:yield_kg_per_ha ?y .
-      
-      FILTER (?y < 2500.0)
-    }}
-    ORDER BY ?pid
-    """.format(BASE_URI)
-
     try:
-        with QUERY_LOCK:
-            maize_results = list(g.query(maize_query))
-            rain_results = list(g.query(rain_query))
-            yield_results = list(g.query(yield_query))
+        with ds.lock:
+            maize_results = list(ds.graph.query(maize_query))
     except Exception as e:
         print("ERROR in get_plots_high_pest_risk:", e)
         return []
@@ -453,16 +477,21 @@ def get_plots_high_pest_risk():
         pid = str(row["pid"])
         maize_plots[pid] = str(row["crop_name"])
 
-    rain_plots = {}
-    for row in rain_results:
-        pid = str(row["pid"])
-        rain_plots[pid] = float(row["rain"])
+    # High rainfall plots
+    rain_plots = _latest_per_plot(
+        ds, "weather", "forecastRainfallAmount_mm", lambda rain: rain > 950.0)
 
+    # Low yield plots (lowest yield per plot)
+    store = ds.measurements
+    yields = store.columns["yield_kg_per_ha"]
     yield_plots = {}
-    for row in yield_results:
-        pid = str(row["pid"])
-        if pid not in yield_plots or float(row["y"]) < yield_plots[pid]:
-            yield_plots[pid] = float(row["y"])
+    for r in store.rows(kind="yield"):
+        y = yields[r]
+        if not y < 2500.0:
+            continue
+        pid = _plot_pid(ds, r)
+        if pid is not None and (pid not in yield_plots or y < yield_plots[pid]):
+            yield_plots[pid] = y
 
     # Find intersection
     result = []
@@ -480,18 +509,142 @@ def get_plots_high_pest_risk():
 # ---------------------------------------------------------------------
 # 7. Next crop recommendations
 # ---------------------------------------------------------------------
-def get_next_crop_recommendations():
+# Current crop (lower-cased) -> (recommended next crop, its class)
+NEXT_CROP = {
+    "zea mays l.": ("Glycine max L.", "LegumeCrop"),
+    "glycine max l.": ("Zea mays L.", "CerealCrop"),
+}
+
+def build_season_index(history):
+    """
+    Every (plot_id, year, crop_name) season from the plot history, sorted,
+    so a keyset cursor is a bisect instead of a query.
+    """
+    return [
+        (pid, year, name)
+        for pid in sorted(history)
+        for year, name in history[pid]
+    ]
+
+
+def _season_ranges(seasons, plot_ids, year_from, after):
+    """(start, stop) slices of the season index that can hold matching rows."""
+    def start_of(pid, year):
+        return bisect_left(seasons, (pid, year) if year is not None else (pid,))
+
+    def first_year(pid):
+        years = [y for y in (year_from,) if y is not None]
+        if after is not None and after[0] == pid:
+            years.append(after[1] + 1)
+        return max(years) if years else None
+
+    if not plot_ids:
+        if after is None:
+            return [(0, len(seasons))]
+        return [(start_of(after[0], after[1] + 1), len(seasons))]
+
+    ranges = []
+    for pid in sorted(set(plot_ids)):
+        if after is not None and pid < after[0]:
+            continue
+        # (pid + "\0",) sorts after every row of pid and before the next plot.
+        ranges.append((start_of(pid, first_year(pid)), start_of(pid + "\0", None)))
+    return ranges
+
+
+def iter_next_crop_recommendations(plot_ids=None, year_from=None, year_to=None,
+                                   crop=None, after=None,
+                                   farm: str = DEFAULT_FARM):
+    """
+    Iterate over next-crop recommendations ordered by (plot_id, year).
+
+    Rows come from the dataset's sorted season index: the cursor and plot
+    filters are bisected to, so a page costs the rows it returns, not a
+    query over the whole history. `after` is a (plot_id, year) cursor;
+    only rows strictly after it are produced. `crop` restricts to one
+    current crop name (case-insensitive).
+    """
+    ds = get_dataset(farm)
+    if crop:
+        crops = {crop.strip().lower()}
+        if not crops <= set(NEXT_CROP):
+            return iter(())
+    else:
+        crops = set(NEXT_CROP)
+    seasons = ds.season_index
+    after = tuple(after) if after is not None else None
+
+    def _generate(last):
+        for start, stop in _season_ranges(seasons, plot_ids, year_from, after):
+            for i in range(start, stop):
+                pid, year, current = seasons[i]
+                if year_from is not None and year < year_from:
+                    continue
+                if year_to is not None and year > year_to:
+                    continue
+                if current.lower() not in crops:
+                    continue
+                if last is not None and (pid, year) <= last:
+                    continue  # same plot-year listed under another crop name
+                last = (pid, year)
+                next_name, next_class = NEXT_CROP[current.lower()]
+                yield {
+                    "plot_id": pid,
+                    "year": year,
+                    "current_crop": current,
+                    "recommended_next_crop": next_name,
+                    "recommended_next_crop_class": next_class,
+                }
+
+    return _generate(after)
+
+
+def get_next_crop_recommendations(plot_ids=None, year_from=None, year_to=None,
+                                  crop=None, farm: str = DEFAULT_FARM):
     """
     Simple crop-rotation recommendation:
       - If current crop is Zea mays L.  -> recommend next crop Glycine max L. (legume)
       - If current crop is Glycine max L. -> recommend next crop Zea mays L. (cereal)
     """
+    return list(iter_next_crop_recommendations(
+        plot_ids=plot_ids, year_from=year_from, year_to=year_to, crop=crop,
+        farm=farm,
+    ))
+
 
-    # Case 1: maize -> recommend soybean
-    query_maize = """
+# ---------------------------------------------------------------------
+# 8. Rotation planning from each plot's latest seasons
+# ---------------------------------------------------------------------
+# Crop class per crop name (lower-cased), as used in the recommendations.
+CROP_CLASS = {
+    "zea mays l.": "CerealCrop",
+    "glycine max l.": "LegumeCrop",
+    "triticum aestivum l.": "CerealCrop",
+}
+
+# Named rotation cycles. A plot is placed in the cycle by its latest
+# seasons and the recommendation is the crop that follows. Planners can
+# also pass their own cycle as comma-separated CROP_CLASS crop names.
+ROTATION_SEQUENCES = {
+    "maize-soybean-wheat": ["Zea mays L.", "Glycine max L.", "Triticum aestivum L."],
+    "maize-soybean": ["Zea mays L.", "Glycine max L."],
+    "maize-maize-soybean": ["Zea mays L.", "Zea mays L.", "Glycine max L."],
+}
+DEFAULT_ROTATION = "maize-soybean-wheat"
+
+# How many recent seasons are compared against the sequence by default.
+DEFAULT_LOOKBACK = 3
+
+
+def build_plot_history(graph):
+    """
+    Per-plot crop history index: plot_id -> [(year, crop_name), ...] in year
+    order. Built once from a single query so planners never rescan yields.
+    """
+    query = """
     PREFIX sf: <{}>
 
-    SELECT ?pid ?y ?current_name
+    SELECT DISTINCT ?pid ?y ?name
     WHERE {{
       ?yr a sf:YieldRecord ;
           sf:aboutPlot ?pl ;
@@ -499,88 +652,682 @@ def get_next_crop_recommendations():
           sf:forCrop ?crop .
 
       ?pl sf:hasPlotID ?pid .
-      ?crop sf:hasCropName ?current_name .
-
-      FILTER (lcase(str(?current_name)) = "zea mays l.")
+      ?crop sf:hasCropName ?name .
     }}
-    ORDER BY ?pid ?y
     """.format(BASE_URI)
 
-    # Case 2: soybean -> recommend maize
-    query_soy = """
+    history = {}
+    for row in graph.query(query):
+        # The same season can come back once per literal form of the crop name.
+        history.setdefault(str(row["pid"]), set()).add(
+            (int(str(row["y"])), str(row["name"]))
+        )
+    return {pid: sorted(seasons) for pid, seasons in history.items()}
+
+
+def _place_in_sequence(recent_crops, sequence):
+    """
+    Find where the most recent seasons sit in the cyclic `sequence`.
+
+    Returns (position of the latest season, number of trailing seasons that
+    agree with the sequence). Position is None if the latest crop is not in
+    the sequence at all.
+    """
+    names = [c.lower() for c in sequence]
+    recent = [c.lower() for c in recent_crops]
+    best_pos, best_matched = None, 0
+    for pos in range(len(names)):
+        matched = 0
+        for back, crop in enumerate(reversed(recent)):
+            if names[(pos - back) % len(names)] != crop:
+                break
+            matched += 1
+        if matched > best_matched:
+            best_pos, best_matched = pos, matched
+    return best_pos, best_matched
+
+
+def rotation_cycle(sequence):
+    """
+    Crop names of a rotation: a ROTATION_SEQUENCES name, or an explicit
+    comma-separated list such as "Zea mays L.,Glycine max L.". ValueError
+    if it is neither.
+    """
+    if sequence in ROTATION_SEQUENCES:
+        return ROTATION_SEQUENCES[sequence]
+    cycle = [name.strip() for name in sequence.split(",")]
+    unknown = [name for name in cycle if name.lower() not in CROP_CLASS]
+    if unknown:
+        raise ValueError(
+            f"Unknown rotation sequence {sequence!r}: expected one of "
+            f"{sorted(ROTATION_SEQUENCES)} or comma-separated crops from "
+            f"{sorted(CROP_CLASS)} (unknown: {unknown})"
+        )
+    # Spelled as in the presets (and the data) whatever case was given.
+    spelling = {name.lower(): name for names in ROTATION_SEQUENCES.values() for name in names}
+    return [spelling.get(name.lower(), name) for name in cycle]
+
+
+def get_rotation_plan(sequence=DEFAULT_ROTATION, lookback=DEFAULT_LOOKBACK,
+                      plot_ids=None, farm: str = DEFAULT_FARM):
+    """
+    One forward-looking recommendation per plot.
+
+    Only the last `lookback` seasons of each plot (from the farm's plot history) are
+    considered, so the cost is O(plots * lookback) regardless of how much
+    yield history has accumulated. `sequence` is anything rotation_cycle
+    accepts.
+    """
+    cycle = rotation_cycle(sequence)
+    lookback = max(1, int(lookback))
+
+    history = get_dataset(farm).plot_history
+    wanted = history.keys() if plot_ids is None else plot_ids
+    plan = []
+    for pid in sorted(wanted):
+        seasons = history.get(pid)
+        if not seasons:
+            continue
+        recent = seasons[-lookback:]
+        pos, matched = _place_in_sequence([crop for _, crop in recent], cycle)
+        # Off-sequence plots restart the cycle.
+        next_crop = cycle[(pos + 1) % len(cycle)] if pos is not None else cycle[0]
+        last_year = recent[-1][0]
+        plan.append({
+            "plot_id": pid,
+            "last_year": last_year,
+            "for_year": last_year + 1,
+            "recent_crops": [{"year": y, "crop": c} for y, c in recent],
+            "rotation": sequence,
+            "matched_seasons": matched,
+            "recommended_next_crop": next_crop,
+            "recommended_next_crop_class": CROP_CLASS.get(next_crop.lower()),
+        })
+    return plan
+
+
+
+# ---------------------------------------------------------------------
+# 9. Yield analytics cube
+# ---------------------------------------------------------------------
+def load_yield_records(ds):
+    """
+    (record_id, {treatment, crop, year, replicate}, yield), one per
+    observed plot / year / replicate.
+
+    The ontology ships its own YieldRecord individuals for plot-years the
+    CSV-generated records also cover; those have no replicate and reduced
+    precision. Where a plot-year has records with a replicate, the ones
+    without are left out, so each observation is counted once (the same
+    choice _export_plot_years makes).
+    """
+    query = """
     PREFIX sf: <{}>
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 
-    SELECT ?pid ?y ?current_name
+    SELECT ?yr ?treatmentCode ?cropName ?rep
     WHERE {{
-      ?yr a sf:YieldRecord ;
-          sf:aboutPlot ?pl ;
-          sf:hasYear ?y ;
-          sf:forCrop ?crop .
-
-      ?pl sf:hasPlotID ?pid .
-      ?crop sf:hasCropName ?current_name .
+      ?yr a sf:YieldRecord .
 
-      FILTER (lcase(str(?current_name)) = "glycine max l.")
+      OPTIONAL {{ ?yr sf:withTreatment ?treat . ?treat rdfs:label ?treatmentCode . }}
+      OPTIONAL {{ ?yr sf:forCrop ?crop . ?crop sf:hasCropName ?cropName . }}
+      OPTIONAL {{ ?yr sf:hasReplicate ?rep . }}
     }}
-    ORDER BY ?pid ?y
     """.format(BASE_URI)
 
-    rows_out = []
-
-    try:
-        # Maize -> next is soybean
-        with QUERY_LOCK:
-            res_maize = list(g.query(query_maize))
-    except Exception as e:
-        print("ERROR in get_next_crop_recommendations (maize query):", e)
-        res_maize = []
-
-    try:
-        # Soybean -> next is maize
-        with QUERY_LOCK:
-            res_soy = list(g.query(query_soy))
-    except Exception as e:
-        print("ERROR in get_next_crop_recommendations (soy query):", e)
-        res_soy = []
-
-    res_maize = list(res_maize)
-    res_soy = list(res_soy)
-    print("DEBUG next-crop maize rows:", len(res_maize))
-    print("DEBUG next-crop soy rows:", len(res_soy))
-
-    for r in res_maize[:5]:
-        print("  maize row:", r)
-    for r in res_soy[:5]:
-        print("  soy row:", r)
-
-    # Build unified output
-    for row in res_maize:
-        rows_out.append(
+    store = ds.measurements
+    records = {}    # (plot, year, replicate) -> (record_id, dims, yield)
+    for row in ds.graph.query(query):
+        r = store.row_of.get(row["yr"])
+        value = store.value(r, "yield_kg_per_ha") if r is not None else None
+        if value is None or not store.year[r]:
+            continue  # only records with a year and a yield
+        record_id = str(row["yr"])
+        replicate = str(row["rep"]) if row["rep"] is not None else None
+        key = (store.plot[r], store.year[r], replicate)
+        # Lowest subject IRI wins, so duplicate label literals and store
+        # order do not change which record is counted.
+        if key in records and records[key][0] <= record_id:
+            continue
+        records[key] = (
+            record_id,
             {
-                "plot_id": str(row["pid"]),
-                "year": int(str(row["y"])),
-                "current_crop": str(row["current_name"]),
-                "recommended_next_crop": "Glycine max L.",
-                "recommended_next_crop_class": "LegumeCrop",
-            }
+                "treatment": str(row["treatmentCode"]) if row["treatmentCode"] is not None else None,
+                "crop": str(row["cropName"]) if row["cropName"] is not None else None,
+                "year": store.year[r],
+                "replicate": replicate,
+            },
+            value,
         )
 
-    for row in res_soy:
-        rows_out.append(
-            {
-                "plot_id": str(row["pid"]),
-                "year": int(str(row["y"])),
-                "current_crop": str(row["current_name"]),
-                "recommended_next_crop": "Zea mays L.",
-                "recommended_next_crop_class": "CerealCrop",
+    replicated = {(plot, year) for plot, year, rep in records if rep is not None}
+    return [
+        record
+        for (plot, year, rep), record in sorted(records.items(), key=lambda kv: kv[1][0])
+        if rep is not None or (plot, year) not in replicated
+    ]
+
+
+def get_yield_analytics(group_by=(), filters=None, farm: str = DEFAULT_FARM):
+    """
+    Mean / median / variance of yield_kg_per_ha grouped by any of
+    treatment, crop, year, replicate, answered from the precomputed cube.
+    """
+    return get_dataset(farm).yield_cube.query(group_by=group_by, filters=filters)
+
+
+
+# ---------------------------------------------------------------------
+# 10. Analog plots (nearest neighbours on soil + weather)
+# ---------------------------------------------------------------------
+# (response key, measurement column) for each feature, in feature-vector order
+ANALOG_FEATURES = [
+    ("pH", "soil_pH"),
+    ("P_mg_per_kg", "soil_P_mg_per_kg"),
+    ("K_mg_per_kg", "soil_K_mg_per_kg"),
+    ("Ca_mg_per_kg", "soil_Ca_mg_per_kg"),
+    ("Mg_mg_per_kg", "soil_Mg_mg_per_kg"),
+    ("CEC", "soil_CEC"),
+    ("OM_pct", "soil_OM_pct"),
+    ("total_precip_mm", "totalPrecip_mm"),
+    ("avg_tmax_C", "avgTmax_C"),
+    ("avg_tmin_C", "avgTmin_C"),
+]
+
+
+def build_analog_index(ds):
+    """
+    One feature vector per (plot_id, year) from its SoilMeasurement and
+    WeatherSummary, the same properties get_plot_year_summary reports.
+    """
+    store = ds.measurements
+    by_key = {}
+    for r in range(len(store)):
+        pid = store.plot_id(r)
+        if pid is not None and store.year[r]:
+            by_key.setdefault((pid, store.year[r]), []).append(r)
+
+    # Some plot-years are measured twice: by the ontology's own individual
+    # and by the record generated from the CSV, which has a replicate and
+    # full-precision values. Take each value from the CSV record (then by
+    # subject IRI), so the choice does not depend on store order.
+    def rank(r):
+        subject = store.subjects[r]
+        return (ds.graph.value(subject, SF.hasReplicate) is None, str(subject))
+
+    vectors = {}
+    outcome = {}
+    for key, rows in by_key.items():
+        rows.sort(key=rank)
+        measured = [r for r in rows if store.is_kind(r, "soil") or store.is_kind(r, "weather")]
+        vec = [
+            next((v for v in (store.value(r, name) for r in measured) if v is not None), None)
+            for _, name in ANALOG_FEATURES
+        ]
+        if any(v is not None for v in vec):
+            vectors[key] = vec
+        for r in rows:
+            value = store.value(r, "yield_kg_per_ha") if store.is_kind(r, "yield") else None
+            if value is None:
+                continue
+            crop = ds.graph.value(store.subjects[r], SF.forCrop)
+            crop_name = ds.graph.value(crop, SF.hasCropName) if crop is not None else None
+            outcome[key] = {
+                "yield_kg_per_ha": value,
+                "crop_name": str(crop_name) if crop_name is not None else None,
             }
-        )
+            break
+
+    keys = sorted(vectors)
+    return AnalogIndex(
+        keys,
+        [vectors[k] for k in keys],
+        extras=[(vectors[k], outcome.get(k)) for k in keys],
+    )
+
+
+def get_analog_plots(plot_id: str, year: int, k: int = 5,
+                     farm: str = DEFAULT_FARM):
+    """
+    The k plot-years whose soil and weather are closest to (plot_id, year),
+    with their features and yields. Returns None if the plot-year has no
+    soil or weather data.
+    """
+    hits = get_dataset(farm).analog_index.nearest((plot_id, year), k=k)
+    if hits is None:
+        return None
+    analogs = []
+    for dist, (pid, yr), (features, outcome) in hits:
+        outcome = outcome or {}
+        analogs.append({
+            "plot_id": pid,
+            "year": yr,
+            "distance": round(dist, 6),
+            "yield_kg_per_ha": outcome.get("yield_kg_per_ha"),
+            "crop_name": outcome.get("crop_name"),
+            "features": {name: val for (name, _), val in zip(ANALOG_FEATURES, features)},
+        })
+    return analogs
+
+
+# ---------------------------------------------------------------------
+# 11. Ad-hoc SPARQL (read-only SELECT under CPU time and row limits)
+# ---------------------------------------------------------------------
+SPARQL_MAX_ROWS = int(os.environ.get("SF_SPARQL_MAX_ROWS", "1000"))
+SPARQL_CPU_SECONDS = float(os.environ.get("SF_SPARQL_CPU_SECONDS", "2"))
+SPARQL_NAMESPACES = {"sf": SF, "rdf": RDF, "rdfs": RDFS, "xsd": XSD}
+
+# Per farm: (normalized query, row limit) -> result, in FarmDataset.sparql_results
+SPARQL_RESULT_CACHE_SIZE = 128
+
+
+def run_sparql(query: str, max_rows=None, farm: str = DEFAULT_FARM):
+    """
+    Run an analyst's SELECT query; returns (result, whether it came from
+    the farm's result cache). Raises SparqlQueryError (a ValueError) if it
+    is rejected or exceeds SPARQL_CPU_SECONDS; at most max_rows (capped at
+    SPARQL_MAX_ROWS) rows are returned.
+
+    Measurement values are answered from the typed columns, so queries can
+    use sf:yield_kg_per_ha etc. as if they were still triples.
+    """
+    if max_rows is None:
+        max_rows = SPARQL_MAX_ROWS
+    max_rows = max(1, min(max_rows, SPARQL_MAX_ROWS))
+
+    ds = get_dataset(farm)
+    # Only parsing takes the farm lock; evaluation of the prepared query
+    # is read-only and runs without it so dashboards are not held up.
+    key, plan = prepare_sparql(query, SPARQL_NAMESPACES, ds.lock)
+
+    # A reload replaces the dataset, so its cache never sees another version.
+    cache_key = (key, max_rows)
+    result = ds.sparql_results.get(cache_key)
+    if result is not None:
+        return result, True
 
-    uniq = {}
-    for item in rows_out:
-        key = (item["plot_id"], item["year"], item["current_crop"])
-        uniq[key] = item
+    extra = ds.measurements.triples if ds.measurements.stripped else None
+    result = execute_sparql(plan, ds.graph, max_rows, SPARQL_CPU_SECONDS, extra)
+    ds.sparql_results.put(cache_key, result)
+    return result, False
+
+
+# ---------------------------------------------------------------------
+# 12. Export slices of plot data (one plot at a time)
+# ---------------------------------------------------------------------
+# kbs_2024.csv header with a columnar type per column
+EXPORT_COLUMNS = [
+    ("Year", "i32"), ("PlotID", "str"), ("Treatment", "str"),
+    ("Replicate", "str"), ("Crop", "str"), ("Yield_kg_ha", "f64"),
+    ("Soil_pH", "f64"), ("P", "f64"), ("K", "f64"), ("Ca", "f64"),
+    ("Mg", "f64"), ("CEC", "f64"), ("OM", "f64"), ("Soil_Measured", "bool"),
+    ("TotalPrecip_mm", "f64"), ("AvgTmax_C", "f64"), ("AvgTmin_C", "f64"),
+]
+
+# CSV column -> measurement column
+EXPORT_MEASUREMENTS = {
+    "Yield_kg_ha": "yield_kg_per_ha",
+    "Soil_pH": "soil_pH",
+    "P": "soil_P_mg_per_kg",
+    "K": "soil_K_mg_per_kg",
+    "Ca": "soil_Ca_mg_per_kg",
+    "Mg": "soil_Mg_mg_per_kg",
+    "CEC": "soil_CEC",
+    "OM": "soil_OM_pct",
+    "TotalPrecip_mm": "totalPrecip_mm",
+    "AvgTmax_C": "avgTmax_C",
+    "AvgTmin_C": "avgTmin_C",
+}
+
+
+def _first(values):
+    return next((v for v in values if v is not None), None)
+
+
+def _export_plot_years(ds, plot_ids, year_from, year_to, crop):
+    """
+    (plot index, plot_id, year, record rows) per selected plot-year, one
+    plot at a time in plot_id order. Records without a year only belong
+    to an export without year bounds, as year=None.
+    """
+    store = ds.measurements
+    wanted = set(plot_ids) if plot_ids else None
+    crop = crop.strip().lower() if crop else None
+    order = sorted(
+        (pid, idx) for idx, pid in enumerate(store.plot_ids) if pid is not None
+    )
+    for pid, idx in order:
+        if wanted is not None and pid not in wanted:
+            continue
+        by_year = {}
+        for r in store.rows_by_plot.get(idx, []):
+            year = store.year[r] or None
+            if year is None and (year_from is not None or year_to is not None):
+                continue
+            if year_from is not None and year < year_from:
+                continue
+            if year_to is not None and year > year_to:
+                continue
+            by_year.setdefault(year, []).append(r)
+
+        selected = []
+        with ds.lock:
+            for year in sorted(by_year, key=lambda y: (y is None, y)):
+                # Records generated from the CSV carry a replicate and the
+                # full-precision values; prefer them over the ontology's own.
+                records = sorted(
+                    by_year[year],
+                    key=lambda r: (
+                        ds.graph.value(store.subjects[r], SF.hasReplicate) is None,
+                        str(store.subjects[r]),
+                    ),
+                )
+                if crop is not None:
+                    names = {
+                        str(ds.graph.value(c, SF.hasCropName)).lower()
+                        for r in records
+                        for c in ds.graph.objects(store.subjects[r], SF.forCrop)
+                    }
+                    if crop not in names:
+                        continue
+                selected.append((year, records))
+        for year, records in selected:
+            yield idx, pid, year, records
+
+
+def iter_export_rows(plot_ids=None, year_from=None, year_to=None, crop=None,
+                     farm: str = DEFAULT_FARM):
+    """
+    One dict per plot-year, keyed like the kbs_2024.csv header
+    (EXPORT_COLUMNS), ordered by plot_id then year. Only one plot's records
+    are looked at at a time.
+    """
+    ds = get_dataset(farm)
+    store = ds.measurements
+    graph = ds.graph
+
+    def _generate():
+        for _, pid, year, records in _export_plot_years(ds, plot_ids, year_from, year_to, crop):
+            if year is None:
+                continue  # the CSV has one row per plot-year
+            with ds.lock:
+                subjects = [store.subjects[r] for r in records]
+                treatments = (graph.value(s, SF.withTreatment) for s in subjects)
+                crops = (graph.value(s, SF.forCrop) for s in subjects)
+                measured = _first(graph.value(s, SF.soilMeasured) for s in subjects)
+                row = {
+                    "Year": year,
+                    "PlotID": pid,
+                    "Treatment": _first(
+                        graph.value(t, RDFS.label) for t in treatments if t is not None),
+                    "Replicate": _first(graph.value(s, SF.hasReplicate) for s in subjects),
+                    "Crop": _first(
+                        graph.value(c, SF.hasCropName) for c in crops if c is not None),
+                    "Soil_Measured": measured.toPython() if measured is not None else None,
+                }
+            for name in ("Treatment", "Replicate", "Crop"):
+                if row[name] is not None:
+                    row[name] = str(row[name])
+            for name, column in EXPORT_MEASUREMENTS.items():
+                row[name] = _first(store.value(r, column) for r in records)
+            yield row
+
+    return _generate()
+
+
+def iter_export_triples(plot_ids=None, year_from=None, year_to=None, crop=None,
+                        farm: str = DEFAULT_FARM):
+    """
+    Triples describing the selected plots and their records (plus the crop
+    and treatment individuals they refer to), one plot at a time.
+    """
+    ds = get_dataset(farm)
+    store = ds.measurements
+    graph = ds.graph
+
+    def describe(subject):
+        with ds.lock:
+            triples = [(subject, p, o) for p, o in graph.predicate_objects(subject)]
+        if store.stripped:
+            triples.extend(store.triples(subject))
+        return triples
+
+    def _generate():
+        seen = set()  # crop / treatment individuals already written
+        current = None
+        for idx, _, _, records in _export_plot_years(ds, plot_ids, year_from, year_to, crop):
+            if idx != current:
+                current = idx
+                yield from describe(store.plots[idx])
+            for r in records:
+                for triple in describe(store.subjects[r]):
+                    yield triple
+                    _, p, o = triple
+                    if p in (SF.forCrop, SF.withTreatment) and o not in seen:
+                        seen.add(o)
+                        yield from describe(o)
+
+    return _generate()
+
+
+# ---------------------------------------------------------------------
+# 13. Reloading changed data + pushing recommendation diffs
+# ---------------------------------------------------------------------
+# How often each process checks whether a loaded farm's files changed
+# (0 disables reloading; data is then only picked up on restart).
+RELOAD_SECONDS = float(os.environ.get("SF_RELOAD_SECONDS", "5"))
+
+# Recommendation sets pushed to /api/recommendations/events subscribers:
+# name -> (function(farm), key of an item)
+RECOMMENDATION_SETS = {
+    "NeedsFertilizerPlot": (get_plots_needing_fertilizer, lambda pid: pid),
+    "PostponeFertilizerPlot": (get_plots_to_postpone_fertilizer, lambda p: p["plot_id"]),
+    "HighPestRiskPlot": (get_plots_high_pest_risk, lambda p: p["plot_id"]),
+    "NextCropRotation": (get_next_crop_recommendations,
+                         lambda r: f"{r['plot_id']}/{r['year']}"),
+}
+
+RECOMMENDATION_EVENTS = EventHub()
+
+# farm -> (graph version, {set name: {key: item}}), kept only for farms
+# that have had subscribers
+_SNAPSHOTS = {}
+_SNAPSHOT_LOCK = Lock()
+
+_reloader_pid = None
+_reloader_lock = Lock()
+
+
+def recommendation_snapshot(farm: str = DEFAULT_FARM):
+    snapshot = {}
+    for name, (compute, key) in RECOMMENDATION_SETS.items():
+        snapshot[name] = {key(item): item for item in compute(farm=farm)}
+    return snapshot
+
+
+def diff_recommendations(old, new):
+    """{set name: {"added", "removed", "changed"}} for the sets that differ."""
+    diffs = {}
+    for name in RECOMMENDATION_SETS:
+        before, after = old.get(name, {}), new.get(name, {})
+        diff = {
+            "added": [after[k] for k in after if k not in before],
+            "removed": [before[k] for k in before if k not in after],
+            "changed": [after[k] for k in after if k in before and before[k] != after[k]],
+        }
+        if any(diff.values()):
+            diffs[name] = diff
+    return diffs
+
+
+def _publish_recommendation_diffs(farm):
+    """Recompute the sets once for the new data and fan the diffs out."""
+    with _SNAPSHOT_LOCK:
+        previous = _SNAPSHOTS.get(farm)
+        if previous is None:
+            return
+        version = get_dataset(farm).version
+        snapshot = recommendation_snapshot(farm)
+        _SNAPSHOTS[farm] = (version, snapshot)
+    for name, diff in diff_recommendations(previous[1], snapshot).items():
+        RECOMMENDATION_EVENTS.publish(farm, "recommendation-diff", {
+            "farm_id": farm,
+            "recommendation": name,
+            "previous_version": previous[0],
+            "version": version,
+            **diff,
+        })
+
+
+def refresh_farm(farm: str = DEFAULT_FARM) -> bool:
+    """
+    Reload a loaded farm if its source files changed since it was loaded.
+    The new dataset is built off to the side and swapped in; requests in
+    flight finish on the old one.
+    """
+    ds = FARMS.get(farm)
+    signature = source_signature(ds.sources)
+    if signature == ds.signature:
+        return False
+    try:
+        unchanged = compute_graph_version(ds.sources) == ds.version
+    except OSError as e:
+        # Missing or half-written: keep serving what is loaded and look
+        # again once the files change.
+        print(f"Not reloading farm {farm}: {e}")
+        unchanged = True
+    if unchanged:
+        ds.signature = signature  # touched, or unreadable for now
+        return False
+
+    print(f"Reloading farm {farm} (source files changed)")
+    FARMS.replace(farm, FarmDataset(farm, farm_sources(farm)).warm())
+    _publish_recommendation_diffs(farm)
+    return True
+
+
+def _reload_loop():
+    while True:
+        time.sleep(RELOAD_SECONDS)
+        for farm in list(FARMS.loaded()):
+            try:
+                refresh_farm(farm)
+            except Exception as e:
+                print(f"ERROR reloading farm {farm}:", e)
+
+
+def _start_reloader():
+    """Start this process's reload thread (again after a fork)."""
+    global _reloader_pid
+    if RELOAD_SECONDS <= 0 or _reloader_pid == os.getpid():
+        return
+    with _reloader_lock:
+        if _reloader_pid != os.getpid():
+            _reloader_pid = os.getpid()
+            Thread(target=_reload_loop, name="sf-reloader", daemon=True).start()
+
+
+def subscribe_recommendations(farm: str = DEFAULT_FARM, last_event_id=None,
+                              notify=None):
+    """
+    Subscription to this farm's recommendation diffs (see scripts/events.py).
+    The first subscriber of a farm pays for its baseline snapshot.
+    """
+    ds = get_dataset(farm)
+    with _SNAPSHOT_LOCK:
+        if farm not in _SNAPSHOTS:
+            _SNAPSHOTS[farm] = (ds.version, recommendation_snapshot(farm))
+    return RECOMMENDATION_EVENTS.subscribe(farm, last_event_id, notify)
+
+
+# ---------------------------------------------------------------------
+# 14. Diagnostics (debug endpoints)
+# ---------------------------------------------------------------------
+# Functions /api/debug/profile may run; each takes farm= plus the
+# keyword arguments given in the request.
+PROFILE_FUNCTIONS = (
+    "list_plots", "get_plot_year_summary", "get_plots_needing_fertilizer",
+    "get_legume_crops", "get_cereal_crops", "get_plots_to_postpone_fertilizer",
+    "get_plots_high_pest_risk", "get_next_crop_recommendations",
+    "get_rotation_plan", "get_yield_analytics", "get_analog_plots",
+    "run_sparql", "recommendation_snapshot",
+)
+
+
+def debug_report(farm: str = DEFAULT_FARM, top=None):
+    """Sizes of a farm's graph, columns, derived indexes and caches."""
+    ds = get_dataset(farm)
+    store = ds.measurements
+    with ds.lock:
+        classes, predicates = triple_counts(ds.graph, top)
+
+    cube = ds._yield_cube
+    analogs = ds._analog_index
+    history = ds._plot_history
+    seasons = ds._season_index
+
+    def size(obj):
+        # None = not built yet (indexes are built on first use)
+        return deep_sizeof(obj, skip=(Graph, Store)) if obj is not None else None
+
+    with _SNAPSHOT_LOCK:
+        snapshot = _SNAPSHOTS.get(ds.farm_id)
+    term_cache = None
+    if isinstance(ds.graph.store, MappedGraphStore):
+        term_cache = ds.graph.store._term.cache_info()._asdict()
+
+    return {
+        "farm_id": ds.farm_id,
+        "version": ds.version,
+        "memory_estimate_bytes": ds.memory_estimate,
+        "graph": {
+            "triples": len(ds.graph),
+            "store": type(ds.graph.store).__name__,
+            "classes": classes,
+            "predicates": predicates,
+            "mapped_term_cache": term_cache,
+        },
+        "measurements": {
+            "rows": len(store),
+            "bytes": store.nbytes(),
+            "in_graph": not store.stripped,
+            "values": {
+                name: sum(1 for v in column if not math.isnan(v))
+                for name, column in store.columns.items()
+            },
+        },
+        # None = not built yet (indexes are built on first use). Byte sizes
+        # are approximate (deep_sizeof) and kept apart from the rdflib store.
+        "indexes": {
+            "plot_history_plots": len(history) if history is not None else None,
+            "plot_history_bytes": size(history),
+            "season_index_rows": len(seasons) if seasons is not None else None,
+            "season_index_bytes": size(seasons),
+            "yield_cube_records": len(cube.records) if cube is not None else None,
+            "yield_cube_cells": (
+                sum(len(cells) for cells in cube.cuboids.values())
+                if cube is not None else None
+            ),
+            # cells with their sorted value lists, then the whole cube
+            "yield_cube_cells_bytes": size(cube.cuboids) if cube is not None else None,
+            "yield_cube_bytes": size(cube),
+            "analog_index_points": len(analogs) if analogs is not None else None,
+            "analog_index_bytes": size(analogs),
+        },
+        "caches": {
+            # plans are process-wide, shared by all farms
+            "sparql_plans": len(SPARQL_PLANS),
+            "sparql_plans_bytes": size(SPARQL_PLANS),
+            "sparql_results": len(ds.sparql_results),
+            "sparql_results_bytes": size(ds.sparql_results),
+            "recommendation_snapshots": sorted(_SNAPSHOTS),
+            "recommendation_snapshot_bytes": size(snapshot),
+            "event_subscribers": RECOMMENDATION_EVENTS.subscriber_count(ds.farm_id),
+        },
+        "loaded_farms": FARMS.loaded(),
+    }
 
-    final_rows = sorted(uniq.values(), key=lambda d: (d["plot_id"], d["year"]))
 
-    return final_rows
+# Load the original farm up front, as before tenancy, so a preforking
+# server shares it with its workers and the first request is not slow.
+get_dataset(DEFAULT_FARM).warm()
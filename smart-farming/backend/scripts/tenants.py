@@ -0,0 +1,85 @@
+"""
+LRU pool of per-farm datasets, bounded by estimated memory.
+
+Datasets are loaded on first use. When the pool is over budget the least
+recently used datasets are dropped from it. Requests that already hold a
+dataset keep using it until they finish; eviction only means the next
+request for that farm loads it again. The most recently used farm is
+never evicted, so a single large farm still works.
+"""
+
+import re
+from collections import OrderedDict
+from threading import Lock
+
+FARM_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class UnknownFarmError(LookupError):
+    pass
+
+
+class DatasetPool:
+    """
+    loader(farm_id) -> dataset with a `memory_estimate` attribute (bytes),
+    raising UnknownFarmError if the farm does not exist.
+    """
+
+    def __init__(self, loader, budget_bytes):
+        self.loader = loader
+        self.budget_bytes = budget_bytes
+        self._datasets = OrderedDict()
+        self._lock = Lock()
+        self._loading = {}  # farm_id -> Lock, so a farm is loaded only once
+
+    def get(self, farm_id):
+        if not FARM_ID.match(farm_id or ""):
+            raise UnknownFarmError(farm_id)
+
+        with self._lock:
+            ds = self._datasets.get(farm_id)
+            if ds is not None:
+                self._datasets.move_to_end(farm_id)
+                return ds
+            load_lock = self._loading.setdefault(farm_id, Lock())
+
+        # Load outside the pool lock so hot farms keep being served.
+        with load_lock:
+            with self._lock:
+                ds = self._datasets.get(farm_id)
+                if ds is not None:
+                    self._datasets.move_to_end(farm_id)
+                    return ds
+            try:
+                ds = self.loader(farm_id)
+            except BaseException:
+                with self._lock:
+                    self._loading.pop(farm_id, None)
+                raise
+            # One critical section: a request arriving in between would
+            # otherwise find neither the dataset nor a load lock and load
+            # the farm again.
+            with self._lock:
+                self._datasets[farm_id] = ds
+                self._loading.pop(farm_id, None)
+                self._evict()
+            return ds
+
+    def replace(self, farm_id, ds):
+        """Install a freshly loaded dataset for farm_id (e.g. after a reload)."""
+        with self._lock:
+            self._datasets[farm_id] = ds
+            self._datasets.move_to_end(farm_id)
+            self._evict()
+
+    def _evict(self):
+        total = sum(ds.memory_estimate for ds in self._datasets.values())
+        while total > self.budget_bytes and len(self._datasets) > 1:
+            farm_id, ds = self._datasets.popitem(last=False)
+            total -= ds.memory_estimate
+            print(f"Evicted farm dataset {farm_id} (~{ds.memory_estimate // 2**20} MB)")
+
+    def loaded(self):
+        """{farm_id: memory estimate} in LRU order (coldest first)."""
+        with self._lock:
+            return {fid: ds.memory_estimate for fid, ds in self._datasets.items()}
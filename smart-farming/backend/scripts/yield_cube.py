@@ -0,0 +1,134 @@
+"""
+Pre-aggregated yield statistics (count, mean, median, variance) for every
+combination of the treatment / crop / year / replicate dimensions.
+
+All 16 group-bys are materialized, and each one is indexed by every subset
+of its dimensions, so a roll-up or drill-down is a dict lookup that returns
+its cells already in order. The cube is built in one pass when a farm is
+loaded and rebuilt with the rest of the dataset when the farm is reloaded.
+"""
+
+from itertools import combinations
+
+DIMENSIONS = ("treatment", "crop", "year", "replicate")
+
+# Every subset of DIMENSIONS, in DIMENSIONS order, from () to all four.
+CUBOIDS = [
+    combo
+    for size in range(len(DIMENSIONS) + 1)
+    for combo in combinations(DIMENSIONS, size)
+]
+
+
+class _Cell:
+    """Statistics for one group; values kept sorted for the median."""
+
+    __slots__ = ("count", "mean", "m2", "values")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.values = []
+
+    @classmethod
+    def from_values(cls, values):
+        cell = cls()
+        cell.values = sorted(values)
+        cell.count = len(values)
+        if cell.count:
+            cell.mean = sum(values) / cell.count
+            cell.m2 = sum((v - cell.mean) ** 2 for v in values)
+        return cell
+
+    def summary(self):
+        n = self.count
+        if n == 0:
+            median = None
+        elif n % 2:
+            median = self.values[n // 2]
+        else:
+            median = (self.values[n // 2 - 1] + self.values[n // 2]) / 2
+        return {
+            "count": n,
+            "mean": self.mean if n else None,
+            "median": median,
+            # sample variance; undefined for a single observation
+            "variance": max(self.m2, 0.0) / (n - 1) if n > 1 else None,
+        }
+
+
+class YieldCube:
+    """
+    records: record_id -> ({dimension: value}, yield)
+    cuboids: group-by tuple -> {dimension values tuple: _Cell}
+    slices:  (group-by tuple, filtered dimensions) -> {filtered values: [cell key, ...]},
+             keys ordered by the remaining dimensions
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.cuboids = {dims: {} for dims in CUBOIDS}
+        self.slices = {}
+
+    @classmethod
+    def build(cls, records):
+        """Bulk-build from (record_id, dims, value) tuples, one pass per group-by."""
+        cube = cls()
+        for record_id, dims, value in records:
+            cube.records[record_id] = (dims, value)
+
+        for group_by in CUBOIDS:
+            groups = {}
+            for dims, value in cube.records.values():
+                key = tuple(dims.get(d) for d in group_by)
+                groups.setdefault(key, []).append(value)
+            cube.cuboids[group_by] = {
+                key: _Cell.from_values(values) for key, values in groups.items()
+            }
+            cube._index(group_by)
+        return cube
+
+    def _index(self, group_by):
+        cells = self.cuboids[group_by]
+        for fixed in CUBOIDS:
+            if not set(fixed) <= set(group_by):
+                continue
+            at = [group_by.index(d) for d in fixed]
+            rest = [i for i, d in enumerate(group_by) if d not in fixed]
+            index = {}
+            for key in sorted(cells, key=lambda k: tuple(str(k[i]) for i in rest)):
+                index.setdefault(tuple(key[i] for i in at), []).append(key)
+            self.slices[group_by, fixed] = index
+
+    def cell(self, **filters):
+        """Statistics for exactly one cell, e.g. cell(treatment="T1", year=2015)."""
+        group_by = tuple(d for d in DIMENSIONS if d in filters)
+        key = tuple(filters[d] for d in group_by)
+        found = self.cuboids[group_by].get(key)
+        return found.summary() if found else None
+
+    def query(self, group_by=(), filters=None):
+        """
+        Cells of the `group_by` roll-up, restricted by `filters`.
+
+        Filtered dimensions are looked up in the finer cuboid that includes
+        them, through its slice index, so a drill-down touches only the
+        cells it returns and never the raw records.
+        """
+        filters = filters or {}
+        unknown = set(group_by) - set(DIMENSIONS) or set(filters) - set(DIMENSIONS)
+        if unknown:
+            raise ValueError(f"Unknown dimension(s): {sorted(unknown)}")
+
+        dims = tuple(d for d in DIMENSIONS if d in group_by or d in filters)
+        fixed = tuple(d for d in dims if d in filters)
+        keys = self.slices[dims, fixed].get(tuple(filters[d] for d in fixed), ())
+        cells = self.cuboids[dims]
+        out = []
+        for key in keys:
+            values = dict(zip(dims, key))
+            row = {d: values[d] for d in DIMENSIONS if d in group_by}
+            row.update(cells[key].summary())
+            out.append(row)
+        return out
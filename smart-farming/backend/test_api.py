@@ -54,6 +54,10 @@ endpoints = [
     ("Postpone Fertilizer", "/api/recommendations/postpone-fertilizer"),
     ("High Pest Risk", "/api/recommendations/high-pest-risk"),
     ("Next Crop Recommendations", "/api/recommendations/next-crop"),
+    ("Rotation Plan", "/api/recommendations/rotation-plan"),
+    ("Rotation Plan (custom)", "/api/recommendations/rotation-plan?sequence=Zea%20mays%20L.,Glycine%20max%20L."),
+    ("Yield Analytics", "/api/analytics/yield?group_by=treatment,crop"),
+    ("Ad-hoc SPARQL", "/api/sparql?limit=5&query=SELECT%20%3Fs%20WHERE%20%7B%3Fs%20a%20sf%3APlot%7D"),
 ]
 
 for name, endpoint in endpoints:
@@ -64,6 +68,31 @@ print(f"\n{'='*60}")
 print("Testing: Specific Plot (T1_R1/2015)")
 print(f"{'='*60}")
 test_endpoint("Plot Summary T1_R1/2015", "/api/plots/T1_R1/year/2015")
+test_endpoint("Analog Plots T1_R1/2015", "/api/plots/T1_R1/year/2015/analogs?k=5")
+
+# Exports are streamed CSV / N-Triples / binary, not JSON
+print(f"\n{'='*60}")
+print("Testing: CSV Export (T1_R1, 2011-2015)")
+print(f"{'='*60}")
+try:
+    response = requests.get(f"{BASE_URL}/api/export/csv?plot=T1_R1&year_from=2011&year_to=2015", timeout=10)
+    print(f"Status: {response.status_code}")
+    print(response.text)
+except requests.exceptions.ConnectionError:
+    print(f"✗ Cannot connect to {BASE_URL}")
+
+# The cube's grand total must count each CSV row once
+print(f"\n{'='*60}")
+print("Testing: Yield Analytics total vs data/kbs_2024.csv")
+print(f"{'='*60}")
+try:
+    import csv
+    with open("data/kbs_2024.csv", newline="", encoding="utf-8") as f:
+        csv_rows = sum(1 for row in csv.DictReader(f) if row.get("Yield_kg_ha", "").strip())
+    total = requests.get(f"{BASE_URL}/api/analytics/yield", timeout=10).json()["cells"][0]["count"]
+    print(f"{'✓' if total == csv_rows else '✗'} count={total}, CSV rows with a yield={csv_rows}")
+except requests.exceptions.ConnectionError:
+    print(f"✗ Cannot connect to {BASE_URL}")
 
 print("\n" + "="*60)
 print("Tests complete!")
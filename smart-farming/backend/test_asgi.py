@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Checks for the ASGI serving mode, run in-process (no server needed):
+
+    python test_asgi.py
+"""
+import asyncio
+import os
+import signal
+import threading
+import time
+
+from asgi import PooledApplication
+
+
+async def request(application, path, query_string=b"", sent=None):
+    """Send one GET through the ASGI app; returns (status, body)."""
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    sent = [] if sent is None else sent
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)  # no disconnect while the request runs
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "method": "GET", "path": path, "root_path": "",
+        "query_string": query_string, "headers": [], "server": ("localhost", 5000),
+        "client": ("127.0.0.1", 1234), "scheme": "http", "http_version": "1.1",
+    }
+    await application(scope, receive, send)
+    status = sent[0]["status"]
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return status, body
+
+
+def test_killed_worker_is_replaced():
+    """A dead worker process must not leak slots or break the pool for good."""
+    async def run():
+        application = PooledApplication()
+        path = "/api/analytics/yield"
+        status, _ = await request(application, path)
+        assert status == 200, status
+
+        pool = application.pools["analytic"]
+        for pid in list(pool.executor._processes):
+            os.kill(pid, signal.SIGKILL)
+        time.sleep(0.5)
+
+        # More requests than the pool admits at once: a leaked slot per
+        # failed request would turn these into 503s.
+        statuses = [(await request(application, path))[0]
+                    for _ in range(pool.capacity + 2)]
+        await asyncio.sleep(0.1)  # let done-callbacks release their slots
+        application._stop()
+        return statuses, pool.in_flight
+
+    statuses, in_flight = asyncio.run(run())
+    assert all(s == 200 for s in statuses), statuses
+    assert in_flight == 0, in_flight
+
+
+def test_workers_do_not_inherit_held_locks():
+    """A lock held in this process when workers start must not hang them."""
+    from scripts.query_service import get_dataset
+
+    ds = get_dataset()
+    held = threading.Event()
+
+    def hold_lock():
+        with ds.lock:
+            held.set()
+            time.sleep(2)
+
+    async def run():
+        threading.Thread(target=hold_lock, daemon=True).start()
+        held.wait()
+        application = PooledApplication()
+        application._start()  # workers start while the lock is held
+        pool = application.pools["analytic"]
+        pool.timeout = 15.0
+        path = "/api/recommendations/high-pest-risk"
+        statuses = [(await request(application, path))[0] for _ in range(3)]
+        await asyncio.sleep(0.1)
+        application._stop()
+        return statuses, pool.in_flight
+
+    statuses, in_flight = asyncio.run(run())
+    assert all(s == 200 for s in statuses), statuses
+    assert in_flight == 0, in_flight
+
+
+def test_export_is_streamed():
+    """Exports arrive in several body messages, identical to the WSGI body."""
+    from app import app as wsgi_app
+
+    async def run():
+        application = PooledApplication()
+        sent = []
+        status, body = await request(application, "/api/export/ntriples", b"plot=T1_R1", sent)
+        application._stop()
+        return status, body, sum(m["type"] == "http.response.body" for m in sent)
+
+    status, body, messages = asyncio.run(run())
+    expected = wsgi_app.test_client().get("/api/export/ntriples?plot=T1_R1").data
+    assert status == 200, status
+    assert messages > 2, messages
+    assert body == expected
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            try:
+                test()
+                print(f"✓ {name}")
+            except AssertionError as e:
+                print(f"✗ {name}: {e}")
@@ -95,6 +95,39 @@ function App() {
     init();
   }, []);
 
+  // ========== live recommendation updates (server-sent events) ==========
+
+  useEffect(() => {
+    // The server pushes only what changed after new data is loaded;
+    // the initial fetch above is the baseline.
+    const setters = {
+      NeedsFertilizerPlot: [setNeedsFertPlots, (p) => p],
+      PostponeFertilizerPlot: [setPostponeFertPlots, (p) => p.plot_id],
+      HighPestRiskPlot: [setHighPestRiskPlots, (p) => p.plot_id],
+      NextCropRotation: [setNextCropRecs, (r) => `${r.plot_id}/${r.year}`],
+    };
+
+    const source = new EventSource(
+      `${API_BASE}/api/recommendations/events`
+    );
+    source.addEventListener("recommendation-diff", (e) => {
+      const diff = JSON.parse(e.data);
+      const entry = setters[diff.recommendation];
+      if (!entry) return;
+      const [setItems, key] = entry;
+      const replaced = new Set(
+        [...diff.removed, ...diff.changed].map(key)
+      );
+      setItems((items) => [
+        ...items.filter((item) => !replaced.has(key(item))),
+        ...diff.changed,
+        ...diff.added,
+      ]);
+    });
+
+    return () => source.close();
+  }, []);
+
   // ========== load plot/year summary when selection changes ==========
 
   useEffect(() => {